@@ -0,0 +1,1151 @@
+"""
+This code can be used to measure the performance of Eindopdracht.py
+
+Run without arguments for the individual benchmarks below. With --suite a fixed
+set of synthetic expressions is timed for every hot path of Eindopdracht and,
+where they are comparable, of Firstversion; the results are written as JSON and
+can be compared against a saved baseline with --compare.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import pickle
+import platform
+import random
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import Eindopdracht
+from Eindopdracht import *
+
+import EOServer
+import Firstversion
+
+
+# build a left-deep tree mixing all operators and a couple of variables
+def deep_tree(depth):
+    ops = [AddNode, MulNode, SubNode, TrueDivNode]
+    expr = Variable('x')
+    for i in range(depth):
+        if i % 5 == 0:
+            rhs = Variable('y')
+        else:
+            rhs = Constant(i % 7 + 1.5)
+        expr = ops[i % len(ops)](expr, rhs)
+    return expr
+
+
+# generate a flat formula of (about) the given size in bytes, mixing
+# integers, floats in scientific notation, multi-letter variables and all operators
+def generate_formula(size, seed=1, scientific=True):
+    rng = random.Random(seed)
+    ops = ['+', '-', '*', '/', '%', '//', '**']
+    operands = ['x', 'y1', 'rate', '17', '3.25', '(alpha + 4)']
+    # the legacy tokenizer splits 2.5e-3 into 2.5e, - and 3
+    if scientific:
+        operands.append('2.5e-3')
+    parts = [rng.choice(operands)]
+    length = len(parts[0])
+    while length < size:
+        op = rng.choice(ops)
+        operand = rng.choice(operands)
+        parts.append(' %s %s' % (op, operand))
+        length += len(op) + len(operand) + 2
+    return ''.join(parts)
+
+
+# the tokenizer as it was before the scanner, to compare against
+def legacy_tokenize(string):
+    splitchars = list("+-*/(),%")
+    tokenstring = []
+    for c in string:
+        if c in splitchars:
+            tokenstring.append(' %s ' % c)
+        else:
+            tokenstring.append(c)
+    tokens = ''.join(tokenstring).split()
+    ans = []
+    for t in tokens:
+        if len(ans) > 0 and t == ans[-1] == '*':
+            ans[-1] = '**'
+        elif len(ans) > 0 and t == ans[-1] == '/':
+            ans[-1] = '//'
+        else:
+            ans.append(t)
+    # the old parser then probed every token with float() and int()
+    for t in ans:
+        isnumber(t) and isint(t)
+    return ans
+
+
+# the shunting-yard parser as it was before precedence climbing, to compare against
+def legacy_parse(string):
+    stack = []
+    output = []
+    oplist = ['+', '-', '*', '/', '**', '%', '//']
+    for token in legacy_tokenize(string):
+        if isnumber(token):
+            if isint(token):
+                output.append(Constant(int(token)))
+            else:
+                output.append(Constant(float(token)))
+        elif token in oplist:
+            while True:
+                if len(stack) == 0 or stack[-1] not in oplist \
+                or int(assoc(token)) == 0 and int(prec(stack[-1])) > int(prec(token)) \
+                or int(assoc(token)) == 1 and int(prec(stack[-1])) >= int(prec(token)):
+                    break
+                output.append(stack.pop())
+            stack.append(token)
+        elif token == '(':
+            stack.append(token)
+        elif token == ')':
+            while not stack[-1] == '(':
+                output.append(stack.pop())
+            stack.pop()
+        else:
+            output.append(Variable(token))
+    while len(stack) > 0:
+        output.append(stack.pop())
+    for t in output:
+        if t in oplist:
+            y = stack.pop()
+            x = stack.pop()
+            stack.append(eval('x %s y' % t))
+        else:
+            stack.append(t)
+    return stack[0]
+
+
+# the recursive printer as it was before, to compare against
+def legacy_str(expr):
+    if not isinstance(expr, BinaryNode):
+        return str(expr)
+    lstring = legacy_str(expr.lhs)
+    rstring = legacy_str(expr.rhs)
+    oplist = ['+', '-', '*', '/', '**', '%', '//']
+    for token in lstring:
+        if token in oplist:
+            if (int(assoc(token)) == 0 and int(prec(token) <= int(prec(expr.op_symbol)))):
+                return "%s %s %s" % (lstring, expr.op_symbol, rstring)
+            elif ((int(assoc(token)) == 1 and int(prec(token))) < int(prec(expr.op_symbol))):
+                return "(%s) %s %s" % (lstring, expr.op_symbol, rstring)
+    return "%s %s %s" % (lstring, expr.op_symbol, rstring)
+
+
+# the character-by-character comparison BinaryNode.expteq made before compare, returning
+# whether the operators and the digits of the constants agree instead of printing it
+def legacy_expteq(expr, other):
+    oplist = ['+', '-', '*', '/', '**', '%', '//']
+    charlist = ['(', ')', ' ', '.']
+    ans = []
+    for string in (str(expr), str(other)):
+        ops = str()
+        constants = str()
+        for i in string:
+            if i in oplist:
+                ops += str(i)
+            elif isint(i) and isnumber(i):
+                constants += str(i)
+            elif i not in charlist:
+                pass
+        ans.append((ops, constants))
+    return ans[0][0] == ans[1][0], ans[0][1] == ans[1][1]
+
+
+# Firstversion's string rewriting replace, evaluate and minimum as they were before they
+# worked on the tree, to compare against; they rescan the printed string after every step
+def legacy_replace(self, var = None):
+    "A function for replacing a variable with its respective value from a dictionary"
+    self = str(self)
+    if var == None:
+        return self
+    else:
+        ans = str()
+        for i in self:
+            if i in var:
+                j = var.get(i)
+                ans += str(j)
+            else:
+                ans += str(i)    
+        self = ans
+        return self
+
+        
+def legacy_evaluate(self,var=None):
+    "A function for the evaluation of an Expression"
+    new=legacy_replace(self,var) 
+    charlist = ['+', '-', '*', '/', '**', '%', '//', '(', ')']
+    oplist = ['+','-','*','/','**', '%','//']
+    i = 0
+    def calc(string):
+        "A Function that will return a float from input, here the input is a part of the Expression tree"
+        calc = str(string)
+        i = 0
+        j = 0
+        k = 0
+        newcalc=0
+        #Finding an operation from the oplist (First while statement)
+        #Finding an character from the charlist to the left of the found operation from first while statement (second while statement)
+        #Finding of a character from the charlist to the right of the found operation from first while statement (third while statement)
+        while i < len(calc):
+            if calc[i] in oplist:
+                if calc[i] == '+':
+                    j = i - 1
+                    while j >= 0:
+                        if calc[j] in charlist:
+                            k = i + 1
+                            while k <= len(calc):
+                                if calc[k] in charlist:
+                                    newcalc += float(calc[j + 1:i]) + float(calc[i + 1:k])
+                                    calc = calc[:j] + str(newcalc) + calc[k:]
+                                    k = (len(calc) + 1)
+                                else:
+                                    k += 1
+                            j = -1
+                            i = 0
+                        else:
+                            j -= 1
+                if calc[i] == '-':
+                    j = i - 1
+                    while j >= 0:
+                        if calc[j] in charlist:
+                            k=i+1
+                            while k <= len(calc):
+                                if calc[k] in charlist:
+                                    newcalc += float(calc[j + 1:i])-float(calc[i + 1:k])
+                                    calc=calc[:j] + str(newcalc) + calc[k:]
+                                    k = (len(calc) + 1)
+                                else:
+                                    k += 1
+                            j = -1
+                            i = 0
+                        else:
+                            j -= 1
+                if calc[i] == '*' and calc[i + 1] == '*':
+                    #Found an ** operation, requires an altered code
+                    j = i - 1
+                    while j >= 0:
+                        if calc[j] in charlist:
+                            k = i + 2
+                            while k <= len(calc):
+                                if calc[k] in charlist:
+                                    newcalc += float(calc[j + 1:i]) ** float(calc[i + 2:k])
+                                    calc = calc[:j] + str(newcalc) + calc[k:]
+                                    k = (len(calc) + 1)
+                                else:
+                                    k += 1
+                            j = -1
+                            i = 0
+                        else:
+                            j -= 1
+                if calc[i] == '/' and calc[i + 1] == '/':
+                    #Found an // operation, requires an altered code 
+                    j = i - 1
+                    while j >= 0:
+                        if calc[j] in charlist:
+                            k = i + 2
+                            while k <= len(calc):
+                                if calc[k] in charlist:
+                                    newcalc += float(calc[j + 1:i]) // float(calc[i + 2:k])
+                                    calc = calc[:j] + str(newcalc) + calc[k:]
+                                    k = (len(calc) + 1)
+                                else:
+                                    k += 1
+                            j = -1
+                            i = 0
+                        else:
+                            j -= 1
+                if calc[i] == '*':
+                    j = i - 1
+                    while j >= 0:
+                        if calc[j] in charlist:
+                            k = i + 1
+                            while k <= len(calc):
+                                if calc[k] in charlist:
+                                    newcalc += float(calc[j + 1:i]) * float(calc[i + 1:k])
+                                    calc = calc[:j] + str(newcalc) + calc[k:]
+                                    k = (len(calc) + 1)
+                                else:
+                                    k += 1
+                            j = -1
+                            i = 0
+                        else:
+                            j -= 1            
+                if calc[i] == '/':
+                    j = i - 1
+                    while j >= 0:
+                        if calc[j] in charlist:
+                            k = i + 1
+                            while k <= len(calc):
+                                if calc[k] in charlist:
+                                    newcalc += float(calc[j + 1:i]) / float(calc[i + 1:k])
+                                    calc = calc[:j] + str(newcalc) + calc[k:]
+                                    k = (len(calc) + 1)
+                                else:
+                                    k += 1
+                            j = -1
+                            i = 0
+                        else:
+                            j -= 1
+                if calc[i] == '%':
+                    j = i - 1
+                    while j >= 0:
+                        if calc[j] in charlist:
+                            k = i + 1
+                            while k <= len(calc):
+                                if calc[k] in charlist:
+                                    newcalc += float(calc[j + 1:i]) % float(calc[i + 1:k])
+                                    calc = calc[:j] + str(newcalc) + calc[k:]
+                                    k = (len(calc) + 1)
+                                else:
+                                    k += 1
+                            j = -1
+                            i = 0
+                        else:
+                            j -= 1            
+                else:
+                    i += 1
+                    
+            else:
+                i += 1
+        newcalc = str()
+        remove = str()
+        #Dicarding the brackets from the string for representation
+        for i in calc:
+            if i == '(' or i == ')':
+                remove += i
+            else:
+                newcalc += i
+        calc = newcalc        
+        return calc
+    #Finding the first part of the Expression to be evaluated by the function calc()    
+    count = new.count("(") 
+    while i < len(new):
+        if new[i] == '(':
+            if count == 1:    
+                j = i + 1
+                while j < len(new):
+                    if new[j] == ')':
+                        ans = (calc(new[i:j + 1]))
+                        new = new[:i] + str(ans) + new[j + 1:]
+                        j = len(new)
+                        i = 0
+                        count = new.count("(")
+                    else:
+                        j += 1
+            else:
+                count -= 1
+                i += 1
+        else:
+            i += 1
+    return new
+
+
+def legacy_minimum(self):
+    "A function to limit the amount of brackets in the Expresion"
+    oplist = ['+', '-', '*', '/', '**', '%', '//']
+    oplist2 = ['+','-']
+    oplist3 = ['*','/']
+    oplist4 = ['**']
+    oplist5 = ['%']
+    oplist6 = ['//']
+    new = (str(self))
+    i = 0
+    j = 0
+    #This algortihm works in a similar manner as de while statements of the function evaluate.calc(). It determines wheter brackets are needed between two operations
+    while i < len(new):
+        if new[i] in oplist:
+            if new[i] in oplist2:
+                j = i + 1
+                while j < len(new):
+                    if new[j] in oplist:
+                        if new[j] in oplist2:
+                            new1 = new[i:j]
+                            new2 = str()
+                            for k in new1:
+                                if k != ')':
+                                    new2 += k
+                            new3 = str()
+                            new3 = new[0:i] + new2 + new[j:len(new)]
+                            l = i
+                            while l >= 0:
+                                if new3[l] == '(':
+                                    new4 = str()
+                                    new4 = new3[:l] + new3[l + 1:]
+                                    new = new4
+                                    i = 0
+                                    j = 0
+                                    l = -1
+                                else:
+                                    l -= 1
+                            j = len(new)    
+                        else:
+                            j = len(new)
+                    else:
+                        j += 1
+            elif new[i] in oplist3:
+                j = i + 1
+                while j < len(new):
+                    if new[j] in oplist:
+                        if new[j] in oplist3 or new[j] in oplist2:
+                            new1 = new[i:j]
+                            new2 = str()
+                            for k in new1:
+                                if k != ')':
+                                    new2 += k
+                            new3 = str()
+                            new3 = new[0:i] + new2 + new[j:len(new)]
+                            l = i
+                            while l >= 0:
+                                if new3[l] == '(':
+                                    new4 = str()
+                                    new4 = new3[:l] + new3[l + 1:]
+                                    new = new4
+                                    i = 0
+                                    j = 0
+                                    l = -1
+                                else:
+                                    l -= 1
+                            j = len(new)    
+                        else:
+                            j = len(new)
+                    else:
+                        j += 1 
+            if new[i] in oplist4:
+                j = i + 1
+                while j < len(new):
+                    if new[j] in oplist:
+                        if new[j] in oplist4:
+                            new1 = new[i:j]
+                            new2 = str()
+                            for k in new1:
+                                if k != ')':
+                                    new2 += k
+                            new3 = str()
+                            new3 = new[0:i] + new2 + new[j:len(new)]
+                            l = i
+                            while l >= 0:
+                                if new3[l] == '(':
+                                    new4 = str()
+                                    new4 = new3[:l] + new3[l + 1:]
+                                    new = new4
+                                    i = 0
+                                    j = 0
+                                    l = -1
+                                else:
+                                    l -= 1
+                            j = len(new)    
+                        else:
+                            j = len(new)
+                    else:
+                        j += 1            
+            i = len(new)
+        else:
+           i += 1
+    return new
+
+
+# a sum of n terms, built left-deep as a + b + c + ... would be
+def long_sum(n):
+    expr = Variable('x0')
+    for i in range(1, n):
+        expr = expr + Variable('x%d' % i)
+    return expr
+
+
+# a node the way they were stored before __slots__: every attribute in a __dict__,
+# including the operator of every BinaryNode
+class LegacyNode():
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+# copy a tree into LegacyNodes, to compare the memory use against
+def legacy_tree(expr):
+    def leaf(node):
+        if isinstance(node, Constant):
+            return LegacyNode(value=node.value, _hash=hash(node))
+        return LegacyNode(variable=node.variable, _hash=hash(node))
+    return expr.fold(leaf, lambda node, lhs, rhs: LegacyNode(lhs=lhs, rhs=rhs, op_symbol=node.op_symbol, _hash=hash(node)))
+
+
+# the memory in bytes allocated (and still held) by a call of a callable, and its result
+def allocated(function):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = function()
+        return tracemalloc.get_traced_memory()[0] - before, result
+    finally:
+        tracemalloc.stop()
+
+
+# time a single call of a callable in seconds
+def once(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+# time a callable, return the best time per call in microseconds
+def best(function, number, repeat=5):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e6
+
+
+def bench_compile(depths=(10, 100, 500), number=200):
+    "Compare the tree-walking evaluate with a call to the compiled function"
+    dic = {'x': 1.25, 'y': 0.75}
+    print('compile: evaluate(dic) vs compile()(**dic)')
+    for depth in depths:
+        expr = deep_tree(depth)
+        function = expr.compile()
+        assert function(**dic) == expr.evaluate(dic)
+        t_eval = best(lambda: expr.evaluate(dic), number)
+        t_comp = best(lambda: function(**dic), number)
+        print('  depth %5d: evaluate %10.2f us, compiled %8.2f us, speedup %6.1fx'
+              % (depth, t_eval, t_comp, t_eval / t_comp))
+
+
+def bench_batch(sizes=(1000, 100000)):
+    "Compare a loop of evaluate calls with one evaluate_batch call over all points"
+    if np is None:
+        print('batch: skipped, NumPy is not installed')
+        return
+    expr = Expression.fromString('x**2-4') * Variable('y') + Variable('x') // Constant(3)
+    print('batch: loop of evaluate(dic) vs evaluate_batch(arrays)')
+    for size in sizes:
+        xs = np.linspace(-10, 10, size)
+        t_loop = best(lambda: [expr.evaluate({'x': x, 'y': 2.0}) for x in xs], 1, 3)
+        t_batch = best(lambda: expr.evaluate_batch({'x': xs, 'y': 2.0}), 1, 3)
+        print('  %8d points: loop %12.1f us, batch %10.1f us, speedup %7.1fx'
+              % (size, t_loop, t_batch, t_loop / t_batch))
+
+
+def bench_roots(epsilons=(1e-2, 1e-4, 1e-6)):
+    "Time findAllRoots on x**3 - x, the fixed-step scan needed 2 * (b - a) / epsilon evaluations"
+    expr = Expression.fromString('x**3-x')
+    print('roots: findAllRoots(x**3 - x) on [-10, 10]')
+    for epsilon in epsilons:
+        t_roots = best(lambda: expr.findAllRoots('x', -10, 10, epsilon), 10, 3)
+        print('  epsilon %g: %10.1f us, fixed-step scan would need %d evaluations'
+              % (epsilon, t_roots, 2 * 20 / epsilon))
+
+
+def bench_interval(formulas=('x**3-x', 'x**2+1', '2**x-1000', '1/(x-3)-2', 'x**4-10*x**2+9'), epsilon=1e-6):
+    "Count the evaluations of findAllRoots on [-1000, 1000] with and without the interval enclosure"
+    print('interval: evaluations of isolate_roots on [-1000, 1000], epsilon %g' % epsilon)
+    for formula in formulas:
+        expr = Expression.fromString(formula)
+        f = expr._univariate('x')
+        enclosure = expr._enclosure('x')
+        calls = [0, 0]
+        def counted(x):
+            calls[0] += 1
+            return f(x)
+        def counted_enclosure(lo, hi):
+            calls[1] += 1
+            return enclosure(lo, hi)
+        sampled = Eindopdracht.isolate_roots(counted, -1000, 1000, epsilon)
+        sampling = calls[0]
+        calls[0] = 0
+        enclosed = Eindopdracht.isolate_roots(counted, -1000, 1000, epsilon, enclosure=counted_enclosure)
+        print('  %-16s sampling %6d evaluations, %d roots; enclosure %6d + %6d interval evaluations, %d roots'
+              % (formula, sampling, len(sampled), calls[0], calls[1], len(enclosed)))
+
+
+def bench_polynomial(formulas=('x**2-4', 'x**3-2*x-5', 'x**4-10*x**2+9', '(x-1)**3*(x+2)**2'), epsilon=1e-6):
+    "Time findAllRoots on polynomials, solved directly, against the numeric isolation engine"
+    print('polynomial: findAllRoots on [-1000, 1000], epsilon %g' % epsilon)
+    for formula in formulas:
+        expr = Expression.fromString(formula)
+        f = expr._univariate('x')
+        enclosure = expr._enclosure('x')
+        t_numeric = best(lambda: Eindopdracht.isolate_roots(f, -1000, 1000, epsilon, enclosure=enclosure), 3, 3)
+        t_polynomial = best(lambda: expr.findAllRoots('x', -1000, 1000, epsilon), 100, 3)
+        print('  %-18s numeric %10.1f us, polynomial %8.1f us, %d roots'
+              % (formula, t_numeric, t_polynomial, len(expr.findAllRoots('x', -1000, 1000, epsilon))))
+
+def bench_parallel_roots(count=20, epsilon=1e-6):
+    "Time findAllRoots on a product with many roots, serially and split over worker processes"
+    expr = Variable('x') - Constant(1)
+    for k in range(2, count + 1):
+        expr = expr * (Variable('x') - Constant(k))
+    # divided by x**2 + 1, so that it is not solved as a polynomial
+    expr = expr / (Variable('x') ** Constant(2) + Constant(1))
+    print('parallel roots: findAllRoots of (x - 1) * ... * (x - %d) / (x**2 + 1) on [-100, 100], %d CPUs'
+          % (count, os.cpu_count() or 1))
+    t_serial = once(lambda: expr.findAllRoots('x', -100, 100, epsilon))
+    print('  serial      %6.3f s' % t_serial)
+    expected = None
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        roots = []
+        def run():
+            roots[:] = expr.findAllRoots('x', -100, 100, epsilon, workers=workers)
+        t_parallel = once(run)
+        # the result does not depend on the number of workers
+        assert expected is None or roots == expected
+        expected = list(roots)
+        print('  %2d workers  %6.3f s, %d roots' % (workers, t_parallel, len(roots)))
+        workers *= 2
+
+
+def bench_findroot(brackets=((1, 3), (0, 10), (-1000, 1000))):
+    "Compare the number of evaluations findRoot needs with every method on x**3 - 2*x - 5"
+    expr = Expression.fromString('x**3-2*x-5')
+    print('findRoot: evaluations (time) per method on x**3 - 2*x - 5, tol 1e-12')
+    for a, b in brackets:
+        line = []
+        for method in ('bisect', 'brent', 'newton'):
+            root = expr.findRoot('x', a, b, method=method)
+            t_root = best(lambda: expr.findRoot('x', a, b, method=method), 100, 3)
+            line.append('%s %3d (%6.1f us)' % (method, root.evaluations, t_root))
+        print('  [%g, %g]: %s' % (a, b, ', '.join(line)))
+    # a sign change at a pole or a jump is not reported as a converged root
+    for formula, a, b in (('1/(x-3.3)+1/(x+2)', -1000, 1000), ('1/x', -1, 2), ('x//1-0.5', 0.5, 1.5)):
+        for method in ('bisect', 'brent', 'newton'):
+            assert not Expression.fromString(formula).findRoot('x', a, b, method=method).converged
+
+
+def bench_instrumentation(formula='(x+1)*(x-2)**3/(y+4)-x//3+y%7'):
+    "Compare the hot paths without their hooks, with instrumentation disabled and with it enabled"
+    dic = {'x': 1.25, 'y': 0.75}
+    expr = Expression.parseString(formula)
+    cases = (('parseString', lambda: Expression.parseString(formula), lambda: Expression.parseString.__wrapped__(formula)),
+             ('evaluate', lambda: expr.evaluate(dic), lambda: BinaryNode.evaluate.__wrapped__(expr, dic)))
+    print('instrumentation: without hooks vs disabled vs enabled')
+    for name, hooked, bare in cases:
+        t_bare = best(bare, 1000, 3)
+        t_disabled = best(hooked, 1000, 3)
+        with instrumentation():
+            t_enabled = best(hooked, 1000, 3)
+        print('  %-12s bare %8.2f us, disabled %8.2f us (%+5.1f%%), enabled %8.2f us'
+              % (name, t_bare, t_disabled, (t_disabled / t_bare - 1) * 100, t_enabled))
+
+
+def bench_interning(depths=(100, 300)):
+    "Compare equality of two equal trees built with and without interning"
+    print('interning: a == b for equal deep trees')
+    for depth in depths:
+        a, b = deep_tree(depth), deep_tree(depth)
+        t_plain = best(lambda: a == b, 1000, 3)
+        with interning():
+            a, b = deep_tree(depth), deep_tree(depth)
+        t_interned = best(lambda: a == b, 1000, 3)
+        print('  depth %5d: equality plain %8.2f us, interned %8.2f us'
+              % (depth, t_plain, t_interned))
+
+
+def bench_parse_cache(formula='(x+1)*(x-2)**3/(y+4)-x//3+y%7'):
+    "Compare parsing a formula with fetching it from the parse cache"
+    print('parse cache: parseString vs fromString hit')
+    Expression.fromString(formula)
+    t_parse = best(lambda: Expression.parseString(formula), 1000, 3)
+    t_hit = best(lambda: Expression.fromString(formula), 1000, 3)
+    print('  parse %8.2f us, cache hit %8.2f us, speedup %6.1fx' % (t_parse, t_hit, t_parse / t_hit))
+
+
+def bench_scan(sizes=(1 << 20, 4 << 20)):
+    "Compare the single-pass scanner with the old tokenizer on multi-megabyte formulas"
+    print('scan: legacy tokenize + type probing vs the parser\'s scanner vs parseString')
+    for size in sizes:
+        formula = generate_formula(size)
+        megabytes = len(formula) / 1e6
+        t_legacy = once(lambda: legacy_tokenize(formula))
+        t_scan = once(lambda: Eindopdracht._scan(formula))
+        t_parse = once(lambda: Expression.parseString(formula))
+        print('  %5.1f MB: legacy %6.2f s (%5.1f MB/s), scan %6.2f s (%5.1f MB/s), parse %6.2f s'
+              % (megabytes, t_legacy, megabytes / t_legacy, t_scan, megabytes / t_scan, t_parse))
+
+
+def bench_parse(sizes=(100, 10000, 1 << 20)):
+    "Compare the precedence-climbing parser with the old shunting-yard parser"
+    print('parse: legacy shunting-yard + eval vs precedence climbing')
+    for size in sizes:
+        formula = generate_formula(size, scientific=False)
+        assert legacy_parse(formula) == Expression.parseString(formula)
+        number = max(1, 100000 // size)
+        t_legacy = best(lambda: legacy_parse(formula), number, 3)
+        t_parse = best(lambda: Expression.parseString(formula), number, 3)
+        print('  %8d bytes: legacy %12.1f us, parseString %12.1f us, speedup %5.1fx'
+              % (len(formula), t_legacy, t_parse, t_legacy / t_parse))
+
+
+def bench_str(sizes=(100, 300, 900, 5000, 50000)):
+    "Show how printing a long sum scales, for the old recursive printer and the new one"
+    print('str: printing an n-term sum (the old printer recurses, so it stops below 1000 terms)')
+    for size in sizes:
+        expr = long_sum(size)
+        t_str = once(lambda: str(expr))
+        if size < 1000:
+            t_legacy = once(lambda: legacy_str(expr))
+            print('  %6d terms: legacy %10.1f ms, str %8.2f ms' % (size, t_legacy * 1e3, t_str * 1e3))
+        else:
+            print('  %6d terms: legacy %10s, str %8.2f ms' % (size, '-', t_str * 1e3))
+
+
+def bench_simplify(formula='1*5/9+10*x+2*x*3-x*(4-2)+y*1+0*y+x**1*x**2'):
+    "Compare evaluating a formula before and after simplify, which is done once up front"
+    dic = {'x': 1.25, 'y': 0.75}
+    expr = Expression.fromString(formula)
+    t_simplify = best(lambda: expr.simplify(), 100, 3)
+    simple = expr.simplify()
+    assert abs(simple.evaluate(dic) - expr.evaluate(dic)) < 1e-9
+    t_eval = best(lambda: expr.evaluate(dic), 1000, 3)
+    t_simple = best(lambda: simple.evaluate(dic), 1000, 3)
+    print('simplify: %s -> %s' % (expr, simple))
+    print('  simplify %8.2f us once, evaluate %8.2f us before, %8.2f us after, speedup %5.1fx'
+          % (t_simplify, t_eval, t_simple, t_eval / t_simple))
+
+
+def bench_memory(count=2000, size=200):
+    "Compare the memory held by many parsed formulas as __dict__ nodes, slotted nodes and FlatExpressions"
+    formulas = [generate_formula(size, seed) for seed in range(count)]
+    trees = [Expression.parseString(formula) for formula in formulas]
+    nodes = sum(1 for tree in trees for node in tree.postorder())
+    print('memory: %d formulas of %d bytes, %d nodes' % (count, size, nodes))
+    legacy, _ = allocated(lambda: [legacy_tree(tree) for tree in trees])
+    slotted, _ = allocated(lambda: [tree.copy() for tree in trees])
+    flat, flats = allocated(lambda: [tree.flatten() for tree in trees])
+    for name, size in (('dict nodes', legacy), ('slotted nodes', slotted), ('flat', flat)):
+        print('  %-14s %10d bytes, %6.1f bytes per node' % (name, size, size / nodes))
+    dic = {'x': 1.25, 'y1': 0.75, 'rate': 2.0, 'alpha': 0.5}
+    t_tree = best(lambda: trees[0].evaluate(dic), 1000, 3)
+    t_flat = best(lambda: flats[0].evaluate(dic), 1000, 3)
+    print('  evaluate one formula: tree %8.2f us, flat %8.2f us' % (t_tree, t_flat))
+
+
+def bench_parse_many(count=20000, size=100):
+    "Compare the throughput of parse_many with a growing number of worker processes"
+    formulas = [generate_formula(size, seed) for seed in range(count)]
+    print('parse_many: %d formulas of %d bytes, %d CPUs' % (count, size, os.cpu_count() or 1))
+    t_serial = once(lambda: [Expression.parseString(formula) for formula in formulas])
+    print('  serial parseString          %6.2f s, %8.0f lines/s' % (t_serial, count / t_serial))
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        for flat in (False, True):
+            t_many = once(lambda: list(parse_many(formulas, workers, flat=flat)))
+            print('  %2d workers, %-14s %6.2f s, %8.0f lines/s'
+                  % (workers, 'flat' if flat else 'expressions', t_many, count / t_many))
+        workers *= 2
+
+
+def bench_server(requests=20000, clients=16, idle=0.01):
+    "Measure the throughput of the evaluation server, and answer requests arriving while a batcher stops"
+    async def run():
+        server = EOServer.EvaluationServer(port=0)
+        port = await server.start()
+        try:
+            result = await EOServer.load('127.0.0.1', port, ['x**2 - y', '(x + 1) * (y - 2) / 3'], clients, requests)
+        finally:
+            await server.close()
+        print('server: %d requests from %d clients, %.0f requests/s, p99 %.2f ms'
+              % (result['requests'], clients, result['throughput'], result['p99 ms']))
+        # requests about idle seconds apart arrive around the time the batcher of their
+        # formula gives up waiting, every one of them has to be answered all the same
+        server = EOServer.EvaluationServer(port=0, idle=idle)
+        port = await server.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            start = time.perf_counter()
+            for i in range(100):
+                writer.write(json.dumps({'id': i, 'formula': 'x+1', 'variables': {'x': i}}).encode() + b'\n')
+                answer = json.loads(await asyncio.wait_for(reader.readline(), 5))
+                assert answer == {'id': i, 'value': i + 1.0}
+                await asyncio.sleep(idle * (1 + i % 5 / 10))
+            print('  100 requests around the idle time of %g s answered in %.2f s'
+                  % (idle, time.perf_counter() - start))
+        finally:
+            writer.close()
+            await writer.wait_closed()
+            await server.close()
+    asyncio.run(run())
+
+
+def bench_eval_command(rows=100000, directory=tempfile.gettempdir()):
+    "Time the eval command on a JSON-lines file, and check that it writes valid JSON"
+    source = os.path.join(directory, 'benchmark-eval.jsonl')
+    target = os.path.join(directory, 'benchmark-eval-out.jsonl')
+    rng = random.Random(1)
+    with open(source, 'w') as out:
+        for i in range(rows):
+            out.write(json.dumps({'x': rng.uniform(-10, 10), 'y': rng.uniform(-10, 10)}) + '\n')
+        # results out of the range of floats, and a value which is not a number
+        out.write('{"x": 1e308, "y": 1}\n{"x": "nan", "y": 1}\n')
+    try:
+        t_eval = once(lambda: Eindopdracht.main(['eval', 'c=x*10', 'd=(x+1)*(y-2)/3', '--input', source,
+                                                  '--output', target]))
+        print('eval command: %d JSON lines, 2 formulas, %.2f s, %.0f rows/s' % (rows, t_eval, rows / t_eval))
+        # NaN and Infinity are no JSON, the results are null instead
+        def invalid(name):
+            raise ValueError(name)
+        with open(target) as results:
+            lines = [json.loads(line, parse_constant=invalid) for line in results]
+        assert len(lines) == rows + 2 and lines[-2]['c'] is None and lines[-1]['c'] is None
+    finally:
+        for path in (source, target):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def bench_compare(size=2000, count=1000):
+    "Compare one formula against many variants of it, each with a single constant changed"
+    formula = generate_formula(size)
+    reference = Expression.parseString(formula)
+    rng = random.Random(2)
+    positions = [i for i in range(len(formula)) if formula.startswith(' 17', i)]
+    variants = []
+    for _ in range(count):
+        i = rng.choice(positions)
+        variants.append(Expression.parseString(formula[:i] + ' 18' + formula[i + 3:]))
+    nodes = sum(1 for node in reference.postorder())
+    print('compare: a formula of %d nodes against %d variants' % (nodes, count))
+    comparisons = []
+    def run():
+        comparisons[:] = reference.compare_many(variants)
+    t_many = once(run)
+    assert all(len(comparison.differences) == 1 for comparison in comparisons)
+    t_legacy = once(lambda: [legacy_expteq(reference, variant) for variant in variants])
+    print('  legacy expteq %6.3f s (%6.1f us per variant), compare_many %6.3f s (%6.1f us per variant)'
+          % (t_legacy, t_legacy / count * 1e6, t_many, t_many / count * 1e6))
+
+
+def bench_serialize(count=2000, size=200, path=os.path.join(tempfile.gettempdir(), 'benchmark.eox')):
+    "Compare reparsing, pickle and the binary format for loading many formulas, and loading one from a file"
+    formulas = [generate_formula(size, seed) for seed in range(count)]
+    trees = [Expression.parseString(formula) for formula in formulas]
+    pickled = [pickle.dumps(tree) for tree in trees]
+    dumped = [tree.dumps() for tree in trees]
+    print('serialize: %d formulas of %d bytes' % (count, size))
+    t_parse = once(lambda: [Expression.parseString(formula) for formula in formulas])
+    t_pickle = once(lambda: [pickle.loads(data) for data in pickled])
+    t_loads = once(lambda: [Expression.loads(data) for data in dumped])
+    print('  text   %8d bytes, parse %6.3f s' % (sum(map(len, formulas)), t_parse))
+    print('  pickle %8d bytes, loads %6.3f s' % (sum(map(len, pickled)), t_pickle))
+    print('  dumps  %8d bytes, loads %6.3f s' % (sum(map(len, dumped)), t_loads))
+    dump_file(path, trees)
+    try:
+        with ExpressionFile(path) as expressions:
+            assert expressions[count // 2] == trees[count // 2]
+            t_one = best(lambda: expressions[count // 2], 100, 3)
+            t_all = once(lambda: list(expressions))
+        print('  file   %8d bytes, one by index %8.1f us, all %6.3f s'
+              % (os.path.getsize(path), t_one, t_all))
+    finally:
+        os.remove(path)
+
+
+def bench_incremental(sizes=(100, 1000, 10000), steps=100):
+    "Compare evaluate on the whole dictionary with IncrementalEvaluator.update when one variable changes per step"
+    print('incremental: one of n variables changes per step')
+    for shape in ('chain', 'balanced'):
+        for size in sizes:
+            if shape == 'chain':
+                # every variable is below all the operators before it, on average half the tree is recomputed
+                expr = long_sum(size)
+            else:
+                level = [Variable('x%d' % i) for i in range(size)]
+                while len(level) > 1:
+                    level = [level[i] + level[i + 1] if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)]
+                expr = level[0]
+            dic = dict(('x%d' % i, 1.0) for i in range(size))
+            evaluator = IncrementalEvaluator(expr, dic)
+            rng = random.Random(4)
+            changes = [{'x%d' % rng.randrange(size): rng.random()} for _ in range(steps)]
+            def full():
+                for change in changes:
+                    dic.update(change)
+                    expr.evaluate(dic)
+            def incremental():
+                for change in changes:
+                    evaluator.update(change)
+            t_full = once(full) / steps * 1e6
+            t_incremental = once(incremental) / steps * 1e6
+            assert abs(evaluator.value - expr.evaluate(dic)) < 1e-6 * size
+            print('  %-8s %6d variables: evaluate %10.1f us, update %8.1f us per step, speedup %6.1fx'
+                  % (shape, size, t_full, t_incremental, t_full / t_incremental))
+
+
+def bench_deep(size=10 ** 6):
+    "Build, evaluate, print and compare a sum of a million terms, far beyond the recursion limit"
+    print('deep: %d-term sum' % size)
+    expr = None
+    def build():
+        nonlocal expr
+        expr = long_sum(size)
+    dic = dict(('x%d' % i, 1.0) for i in range(size))
+    t_build = once(build)
+    t_eval = once(lambda: expr.evaluate(dic))
+    t_str = once(lambda: str(expr))
+    t_eq = once(lambda: expr == expr.copy())
+    print('  build %5.2f s, evaluate %5.2f s, str %5.2f s, copy and compare %5.2f s'
+          % (t_build, t_eval, t_str, t_eq))
+
+
+def bench_firstversion(sizes=(10, 30, 100)):
+    "Time Firstversion's replace, evaluate and minimum on the tree against the string rewriting versions"
+    print('firstversion: string rewriting vs one pass over the tree')
+    for shape in ('wide', 'deep', 'balanced'):
+        for size in sizes:
+            expr = suite_shapes[shape](Firstversion, size)
+            dic = {'x': 1.25}
+            line = []
+            for name, legacy, current in (('replace', lambda: legacy_replace(expr, dic), lambda: Firstversion.replace(expr, dic)),
+                                          ('evaluate', lambda: legacy_evaluate(expr, dic), lambda: expr.evaluate(dic)),
+                                          ('minimum', lambda: legacy_minimum(expr), lambda: expr.minimum())):
+                t_current = best(current, 10, 3)
+                try:
+                    t_legacy = once(legacy) * 1e6
+                except Exception:
+                    line.append('%s %10s -> %7.1f us' % (name, 'fails', t_current))
+                    continue
+                if name == 'evaluate' and not math.isclose(float(legacy()), float(current()), rel_tol=1e-9):
+                    # the string version rounds every step to str(), or reads a formula wrongly
+                    name += '*'
+                line.append('%s %10.1f -> %7.1f us' % (name, t_legacy, t_current))
+            print('  %-8s %4d: %s' % (shape, size, ', '.join(line)))
+
+
+# the shapes of the synthetic expressions used by the suite; each is built from the
+# node classes of a module, so the same tree can be built for Firstversion as well
+def shape_wide(module, n):
+    "A left-deep chain of n leaves, as a long formula would be parsed"
+    ops = [module.AddNode, module.MulNode, module.SubNode, _division(module)]
+    expr = _leaf(module, 0)
+    for i in range(1, n):
+        expr = ops[i % len(ops)](expr, _leaf(module, i))
+    return expr
+
+
+def shape_deep(module, n):
+    "A right-nested chain of n leaves, every operator in parentheses"
+    ops = [module.AddNode, module.MulNode, module.SubNode, _division(module)]
+    expr = _leaf(module, n - 1)
+    for i in reversed(range(n - 1)):
+        expr = ops[i % len(ops)](_leaf(module, i), expr)
+    return expr
+
+
+def shape_balanced(module, n):
+    "A complete binary tree over n leaves"
+    ops = [module.AddNode, module.MulNode]
+    level = [_leaf(module, i) for i in range(n)]
+    depth = 0
+    while len(level) > 1:
+        op = ops[depth % len(ops)]
+        level = [op(level[i], level[i + 1]) if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)]
+        depth += 1
+    return level[0]
+
+
+def shape_variables(module, n):
+    "A sum of n products, each with a variable of its own"
+    expr = module.MulNode(module.Constant(2), module.Variable('v0'))
+    for i in range(1, n):
+        expr = module.AddNode(expr, module.MulNode(module.Constant(i % 7 + 2), module.Variable('v%d' % i)))
+    return expr
+
+
+def _division(module):
+    return getattr(module, 'TrueDivNode', None) or module.DivNode
+
+
+# every fifth leaf is the variable x, the others positive constants
+def _leaf(module, i):
+    if i % 5 == 0:
+        return module.Variable('x')
+    return module.Constant(i % 7 + 1.5)
+
+
+# the polynomial (x - 1) * (x - 2) * ... * (x - n), its roots are 1 ... n
+def polynomial(n):
+    expr = Variable('x') - Constant(1)
+    for k in range(2, n + 1):
+        expr = expr * (Variable('x') - Constant(k))
+    return expr
+
+
+# the polynomial divided by x**2 + 1, the same roots without being a polynomial
+def rational(n):
+    return polynomial(n) / (Variable('x') ** Constant(2) + Constant(1))
+
+
+suite_shapes = {
+    'wide': shape_wide,
+    'deep': shape_deep,
+    'balanced': shape_balanced,
+    'variables': shape_variables,
+}
+# the parser keeps its own stacks, so the deep trees of 3000 leaves parse like the others
+suite_sizes = (10, 100, 500, 3000)
+suite_degrees = (3, 10, 20)
+
+
+# the cases of the suite: (name, callable), generated the same way on every run
+def suite_cases():
+    for shape, build in suite_shapes.items():
+        for size in suite_sizes:
+            expr = build(Eindopdracht, size)
+            text = str(expr)
+            dic = dict(('v%d' % i, 1.0 + i % 3) for i in range(size))
+            dic['x'] = 1.25
+            tag = '%s/%d' % (shape, size)
+            yield 'eo/tokenize/' + tag, lambda text=text: tokenize(text)
+            yield 'eo/fromString/' + tag, lambda text=text: Expression.fromString(text)
+            yield 'eo/evaluate/' + tag, lambda expr=expr, dic=dic: expr.evaluate(dic)
+            yield 'eo/str/' + tag, lambda expr=expr: str(expr)
+    for degree in suite_degrees:
+        expr = polynomial(degree)
+        tag = 'polynomial/%d' % degree
+        yield 'eo/findRoot/' + tag, lambda expr=expr: expr.findRoot('x', 0.5, 1.5)
+        yield 'eo/findAllRoots/' + tag, lambda expr=expr, degree=degree: expr.findAllRoots('x', 0, degree + 1)
+        # polynomials are solved exactly, these go through brent and isolate_roots
+        expr = rational(degree)
+        tag = 'rational/%d' % degree
+        yield 'eo/findRoot/' + tag, lambda expr=expr: expr.findRoot('x', 0.5, 1.5)
+        yield 'eo/findAllRoots/' + tag, lambda expr=expr, degree=degree: expr.findAllRoots('x', 0, degree + 1)
+    # roots between jumps, which are not roots
+    expr = Expression.fromString('x % 1 - 0.5')
+    yield 'eo/findAllRoots/jumps', lambda expr=expr: expr.findAllRoots('x', -10, 10, 1e-6)
+    for shape, build in suite_shapes.items():
+        for size in suite_sizes:
+            expr = build(Firstversion, size)
+            text = str(expr)
+            dic = dict(('v%d' % i, 1.0 + i % 3) for i in range(size))
+            dic['x'] = 1.25
+            tag = '%s/%d' % (shape, size)
+            yield 'fv/tokenize/' + tag, lambda text=text: Firstversion.tokenize(text)
+            yield 'fv/fromString/' + tag, lambda text=text: Firstversion.Expression.fromString(text)
+            yield 'fv/evaluate/' + tag, lambda expr=expr, dic=dic: expr.evaluate(dic)
+            yield 'fv/str/' + tag, lambda expr=expr: str(expr)
+            yield 'fv/minimum/' + tag, lambda expr=expr: expr.minimum()
+
+
+def run_suite(repeat=5, pattern=None, log=None):
+    "Time every case of the suite, return the JSON-ready results: the best time per call in seconds"
+    # fromString should parse every time, not fetch the formula from the cache
+    maxsize = parse_cache.maxsize
+    parse_cache.resize(0)
+    results = {}
+    try:
+        for name, function in suite_cases():
+            if pattern is not None and pattern not in name:
+                continue
+            # Firstversion cannot handle every case, those are left out of the results
+            try:
+                function()
+            except Exception as error:
+                if log is not None:
+                    print('%-36s %12s (%s: %s)' % (name, 'fails', type(error).__name__, error), file=log)
+                continue
+            timer = timeit.Timer(function)
+            number = timer.autorange()[0]
+            results[name] = min(timer.repeat(repeat, number)) / number
+            if log is not None:
+                print('%-36s %12.3f us' % (name, results[name] * 1e6), file=log)
+    finally:
+        parse_cache.resize(maxsize)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'numpy': None if np is None else np.__version__,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=1.25):
+    "Print the ratio current / baseline for every case in both, return the names of the regressions"
+    regressions = []
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        old = baseline['results'][name]
+        new = current['results'][name]
+        ratio = new / old
+        if ratio > threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / threshold:
+            flag = 'faster'
+        else:
+            flag = ''
+        print('%-36s %12.3f us %12.3f us %7.2fx %s' % (name, old * 1e6, new * 1e6, ratio, flag))
+    for name in sorted(set(baseline['results']) ^ set(current['results'])):
+        print('%-36s only in the %s' % (name, 'baseline' if name in baseline['results'] else 'current run'))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Measure the performance of Eindopdracht.py')
+    parser.add_argument('--suite', action='store_true', help='run the benchmark suite and write its results as JSON')
+    parser.add_argument('--output', help='write the JSON results to this file instead of standard output')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare with the JSON results in BASELINE, exit with 1 on a regression')
+    parser.add_argument('--current', metavar='RESULTS', help='compare these JSON results instead of running the suite')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown flagged as a regression (default 1.25)')
+    parser.add_argument('--repeat', type=int, default=5, help='timing repetitions per case, the best one counts (default 5)')
+    parser.add_argument('--filter', help='only run the cases with this in their name, like eo/evaluate')
+    args = parser.parse_args(args)
+    if not args.suite and not args.compare:
+        run_benchmarks()
+        return 0
+    if args.current:
+        with open(args.current) as source:
+            current = json.load(source)
+    else:
+        current = run_suite(args.repeat, args.filter, sys.stderr)
+    if args.suite and not args.current:
+        if args.output:
+            with open(args.output, 'w') as target:
+                json.dump(current, target, indent=2, sort_keys=True)
+        else:
+            json.dump(current, sys.stdout, indent=2, sort_keys=True)
+            print()
+    if args.compare:
+        with open(args.compare) as source:
+            baseline = json.load(source)
+        if args.filter:
+            baseline['results'] = dict((name, seconds) for name, seconds in baseline['results'].items()
+                                       if args.filter in name)
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print('%d regression(s) slower than %.2fx' % (len(regressions), args.threshold))
+            return 1
+    return 0
+
+
+def run_benchmarks():
+    "Run the individual benchmarks"
+    bench_compile()
+    bench_batch()
+    bench_roots()
+    bench_interval()
+    bench_polynomial()
+    bench_parallel_roots()
+    bench_findroot()
+    bench_instrumentation()
+    bench_interning()
+    bench_parse_cache()
+    bench_scan()
+    bench_parse()
+    bench_str()
+    bench_simplify()
+    bench_memory()
+    bench_parse_many()
+    bench_server()
+    bench_eval_command()
+    bench_compare()
+    bench_serialize()
+    bench_incremental()
+    bench_deep()
+    bench_firstversion()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
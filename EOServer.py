@@ -0,0 +1,314 @@
+"""
+A local server which evaluates expressions of Eindopdracht.py for many clients
+
+The protocol is JSON lines over TCP: every request is one line like
+    {"id": 1, "formula": "x**2 - y", "variables": {"x": 2, "y": 3}}
+and is answered, in the order of the requests on the connection, with
+    {"id": 1, "value": 1.0}    or    {"id": 1, "error": "..."}
+Formulas are parsed once (through Eindopdracht's parse cache) and compiled once.
+Concurrent requests for the same formula are evaluated together as one batch,
+with NumPy when it is available. Queues are bounded, so a client which sends
+faster than the server evaluates is slowed down instead of filling the memory.
+
+    python EOServer.py serve --port 8765
+    python EOServer.py load --port 8765 --clients 64 --requests 100000
+    python EOServer.py load --local
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import math
+import random
+import sys
+import time
+
+import Eindopdracht
+from Eindopdracht import Expression
+
+
+class EvaluationServer():
+    """Evaluates JSON-lines requests, batching the ones for the same formula"""
+    def __init__(self, host='127.0.0.1', port=8765, max_batch=1024, queue_size=4096, max_pending=1024,
+                 delay=0.0, idle=5.0):
+        self.host = host
+        self.port = port
+        # the largest number of requests evaluated in one batch
+        self.max_batch = max_batch
+        # the number of requests waiting per formula, and per connection for their answer
+        self.queue_size = queue_size
+        self.max_pending = max_pending
+        # how long a batch waits for more requests after the first one, in seconds
+        self.delay = delay
+        # after how many seconds without requests the batcher of a formula stops
+        self.idle = idle
+        self.requests = 0
+        self.batches = 0
+        # the request queue and the task of every formula with recent requests
+        self._queues = {}
+        self._tasks = {}
+        # the writer of every open connection, by the task handling it
+        self._connections = {}
+        self._server = None
+
+    async def start(self):
+        "Start listening, returns the port (useful with port 0)"
+        self._server = await asyncio.start_server(self._connection, self.host, self.port, limit=1 << 20)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        # the open connections are cut, their handlers read the end and finish
+        for writer in list(self._connections.values()):
+            writer.transport.abort()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        for task in list(self._tasks.values()):
+            task.cancel()
+
+    def info(self):
+        "Return the counters of the server as a dictionary"
+        return {'requests': self.requests, 'batches': self.batches, 'formulas': len(self._queues),
+                'parse cache': Eindopdracht.parse_cache.info()}
+
+    async def _connection(self, reader, writer):
+        # answers are queued in the order of the requests, the bounded queue
+        # stops reading from a client which has too many requests in flight
+        answers = asyncio.Queue(self.max_pending)
+        responder = asyncio.create_task(self._respond(answers, writer))
+        connection = asyncio.current_task()
+        self._connections[connection] = writer
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ConnectionError, ValueError):
+                    break
+                if not line:
+                    break
+                if line.strip():
+                    await answers.put(await self._submit(line))
+        finally:
+            del self._connections[connection]
+            # the responder only stops at this None, unless it failed
+            if not responder.done():
+                await answers.put(None)
+            await responder
+            writer.close()
+
+    # after the client went away, answers are still taken from the queue but dropped,
+    # so that the reading side never waits for room in it
+    async def _respond(self, answers, writer):
+        broken = False
+        while True:
+            answer = await answers.get()
+            if answer is None:
+                return
+            if broken:
+                continue
+            ident, future = answer
+            try:
+                response = await future
+            except Exception as error:
+                response = {'error': '%s: %s' % (type(error).__name__, error)}
+            if ident is not None:
+                response['id'] = ident
+            writer.write(json.dumps(response, allow_nan=False).encode() + b'\n')
+            try:
+                await writer.drain()
+            except ConnectionError:
+                broken = True
+
+    # read one request, returns its id and a future for its answer
+    async def _submit(self, line):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        ident = None
+        try:
+            # NaN and Infinity are no JSON, and could not be sent back in the id
+            request = json.loads(line, parse_constant=_reject_constant)
+            ident = request.get('id')
+            formula = request['formula']
+            variables = request.get('variables', {})
+            if not isinstance(formula, str) or not isinstance(variables, dict):
+                raise ValueError('formula must be a string and variables an object')
+        except (ValueError, KeyError, AttributeError) as error:
+            future.set_exception(ValueError('Bad request: %s' % error))
+            return ident, future
+        self.requests += 1
+        queue = self._queues.get(formula)
+        if queue is None:
+            queue = self._queues[formula] = asyncio.Queue(self.queue_size)
+            self._tasks[formula] = asyncio.create_task(self._batcher(formula, queue))
+        # no await happens between looking up the queue and this put unless the queue
+        # is full; the batcher only stops with an empty queue, after taking it out of
+        # _queues without an await in between, so the request is always answered
+        await queue.put((variables, future))
+        return ident, future
+
+    # collect the requests for one formula in batches and evaluate them
+    async def _batcher(self, formula, queue):
+        items = []
+        try:
+            try:
+                expr = Expression.fromString(formula)
+                function = expr.compile()
+            except Exception as error:
+                expr = function = None
+                failure = error
+            while True:
+                try:
+                    items = [await asyncio.wait_for(queue.get(), self.idle)]
+                except asyncio.TimeoutError:
+                    # a request can arrive while the wait is being cancelled
+                    if not queue.empty():
+                        continue
+                    return
+                await asyncio.sleep(self.delay)
+                while len(items) < self.max_batch and not queue.empty():
+                    items.append(queue.get_nowait())
+                self.batches += 1
+                if function is None:
+                    _fail(items, failure)
+                    continue
+                try:
+                    responses = _evaluate(expr, [v for v, f in items])
+                except Exception as error:
+                    _fail(items, error)
+                    continue
+                for (variables, future), response in zip(items, responses):
+                    if not future.done():
+                        future.set_result(response)
+        finally:
+            del self._queues[formula]
+            del self._tasks[formula]
+            # when the task is cancelled, requests can be left in the batch or the queue
+            while not queue.empty():
+                items.append(queue.get_nowait())
+            _fail(items, RuntimeError('The server stopped'))
+
+
+# answer every request in items, which has no answer yet, with an error
+def _fail(items, error):
+    for variables, future in items:
+        if not future.done():
+            future.set_exception(error)
+
+
+def _reject_constant(name):
+    raise ValueError('%s is not valid JSON' % name)
+
+
+# evaluate an expression for a list of variable bindings, returns a response per binding
+def _evaluate(expr, bindings):
+    columns = dict((name, [variables.get(name) for variables in bindings]) for name in expr.variables())
+    responses = []
+    for value in Eindopdracht._evaluate_chunk([expr], columns, len(bindings))[0]:
+        if isinstance(value, Exception):
+            responses.append({'error': '%s: %s' % (type(value).__name__, value)})
+        elif not math.isfinite(value):
+            # JSON has no numbers for these
+            responses.append({'error': 'OverflowError: Result is %s' % value})
+        else:
+            responses.append({'value': value})
+    return responses
+
+
+# send requests from a number of concurrent connections, with pipeline requests
+# in flight on each, and measure the throughput and the latencies
+async def load(host, port, formulas, clients=16, requests=10000, pipeline=32, seed=1):
+    latencies = []
+    errors = [0]
+    rng = random.Random(seed)
+    names = sorted(set().union(*[Expression.fromString(formula).variables() for formula in formulas]))
+    per_client = [requests // clients + (i < requests % clients) for i in range(clients)]
+    async def client(count):
+        reader, writer = await asyncio.open_connection(host, port, limit=1 << 20)
+        sent = collections.deque()
+        window = asyncio.Semaphore(pipeline)
+        async def receive():
+            for i in range(count):
+                line = await reader.readline()
+                latencies.append(time.perf_counter() - sent.popleft())
+                if 'error' in json.loads(line):
+                    errors[0] += 1
+                window.release()
+        receiver = asyncio.create_task(receive())
+        for i in range(count):
+            await window.acquire()
+            request = {'id': i, 'formula': rng.choice(formulas),
+                       'variables': dict((name, rng.uniform(-10, 10)) for name in names)}
+            sent.append(time.perf_counter())
+            writer.write(json.dumps(request).encode() + b'\n')
+            await writer.drain()
+        await receiver
+        writer.close()
+        await writer.wait_closed()
+    start = time.perf_counter()
+    await asyncio.gather(*[client(count) for count in per_client if count])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1e3
+    return {'requests': len(latencies), 'errors': errors[0], 'seconds': elapsed,
+            'throughput': len(latencies) / elapsed, 'p50 ms': percentile(50), 'p99 ms': percentile(99)}
+
+
+async def run_load(args):
+    server = None
+    if args.local:
+        server = EvaluationServer(args.host, 0, delay=args.delay)
+        args.port = await server.start()
+    try:
+        result = await load(args.host, args.port, args.formula or ['x**2 - y', '(x + 1) * (y - 2) / 3'],
+                            args.clients, args.requests, args.pipeline)
+        if server is not None:
+            result['batches'] = server.batches
+    finally:
+        if server is not None:
+            await server.close()
+    print('%(requests)d requests (%(errors)d errors) in %(seconds).2f s: %(throughput).0f requests/s, '
+          'p50 %(p50 ms).2f ms, p99 %(p99 ms).2f ms' % result)
+    if 'batches' in result:
+        print('%d batches, %.1f requests per batch' % (result['batches'], result['requests'] / max(1, result['batches'])))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Evaluate expressions of Eindopdracht.py for many clients')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='run the server')
+    serve.add_argument('--max-batch', type=int, default=1024, help='requests evaluated in one batch at most (default 1024)')
+    serve.add_argument('--queue-size', type=int, default=4096, help='requests waiting per formula at most (default 4096)')
+    serve.add_argument('--max-pending', type=int, default=1024, help='unanswered requests per connection at most (default 1024)')
+    client = commands.add_parser('load', help='measure the throughput and latency of a server')
+    client.add_argument('--local', action='store_true', help='start a server in this process on a free port')
+    client.add_argument('--clients', type=int, default=16, help='concurrent connections (default 16)')
+    client.add_argument('--requests', type=int, default=10000, help='requests in total (default 10000)')
+    client.add_argument('--pipeline', type=int, default=32, help='requests in flight per connection (default 32)')
+    client.add_argument('--formula', action='append', help='formula to request, may be repeated')
+    for command in (serve, client):
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--port', type=int, default=8765)
+        command.add_argument('--delay', type=float, default=0.0, help='seconds a batch waits for more requests (default 0)')
+    args = parser.parse_args(args)
+    if args.command == 'serve':
+        server = EvaluationServer(args.host, args.port, args.max_batch, args.queue_size, args.max_pending, args.delay)
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
+    else:
+        asyncio.run(run_load(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,42 +1,198 @@
 #!/usr/bin/0python3
 
 """
-Code which saves mathematical expressions as an expression tree, this is done by implementing 
-the Shunting-Yard algorithm to convert the Reverse Polish Notation into an expression tree.
+Code which saves mathematical expressions as an expression tree, this is done by parsing
+the string with precedence climbing, building the nodes of the tree directly.
 This representation can be used to perform several calculations and symbolic manipulation.
+Run python -m Eindopdracht eval "x**2 - y" --input data.csv to evaluate expressions for
+every row of a CSV or JSON-lines file.
 
 B.J.M. van Dijk & M.O. El-Haloush @ Utrecht, 2015
 """
 
+import argparse
+import array
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import fractions
+import functools
+import itertools
+import json
+import keyword
 import math
+import mmap
+import operator
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import weakref
+
+# NumPy is optional, it is only needed for batch evaluation
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Instrumentation():
+    """Counters and timings of the hot paths of this module, see set_instrumentation
+
+    counts holds the number of parse calls, parse cache hits and misses, nodes
+    evaluated per node class ('evaluate AddNode', ...), and function evaluations
+    and iterations of the root finders. times and calls hold the total time in
+    seconds and the number of calls per phase (scan, parse, evaluate, findRoot,
+    ...); the time of a phase includes the phases it calls. Work done in other
+    processes (parse_many, findAllRoots with workers) is not counted.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        "Set all counters and timings back to zero"
+        with self._lock:
+            self.counts = collections.Counter()
+            self.times = collections.Counter()
+            self.calls = collections.Counter()
+
+    def snapshot(self):
+        "Return a copy of the counters and timings as a dictionary"
+        with self._lock:
+            return {'counts': dict(self.counts), 'times': dict(self.times), 'calls': dict(self.calls)}
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def update(self, counts):
+        with self._lock:
+            self.counts.update(counts)
+
+    def record(self, phase, seconds):
+        with self._lock:
+            self.times[phase] += seconds
+            self.calls[phase] += 1
+
+
+# the active Instrumentation, None while instrumentation is disabled; every hook
+# checks this first, so a disabled hook costs a global lookup and a comparison
+_instrumentation = None
+
+
+# enable or disable instrumentation, returns the Instrumentation which was active before (or None)
+# enabling keeps the counters of an active Instrumentation, pass a new Instrumentation to start over
+def set_instrumentation(enabled=True):
+    global _instrumentation
+    previous = _instrumentation
+    if isinstance(enabled, Instrumentation):
+        _instrumentation = enabled
+    elif enabled and _instrumentation is None:
+        _instrumentation = Instrumentation()
+    elif not enabled:
+        _instrumentation = None
+    return previous
+
+
+# return the active Instrumentation, or None
+def get_instrumentation():
+    return _instrumentation
+
+
+# instrument everything within a with-block with a fresh Instrumentation, which is returned
+@contextlib.contextmanager
+def instrumentation():
+    stats = Instrumentation()
+    previous = set_instrumentation(stats)
+    try:
+        yield stats
+    finally:
+        set_instrumentation(previous or False)
+
+
+# decorator which times every call of a function as the given phase while instrumentation is enabled
+def _timed(phase):
+    def decorate(function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            stats = _instrumentation
+            if stats is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.record(phase, time.perf_counter() - start)
+        return timed
+    return decorate
+
+# token types produced by scan
+INT = 'INT'
+FLOAT = 'FLOAT'
+IDENT = 'IDENT'
+OP = 'OP'
+LPAREN = 'LPAREN'
+RPAREN = 'RPAREN'
+COMMA = 'COMMA'
+# marks the end of the input for the parser
+END = 'END'
+
+# a token: its type, its text and its offset in the source string
+Token = collections.namedtuple('Token', ['type', 'text', 'pos'])
+
+# one alternative per token type, preceded by optional whitespace; a float needs a
+# decimal point or an exponent, any other character is an error
+_token_pattern = re.compile(r"""\s*(?:
+      (?P<OP>\*\*|//|[-+*/%])
+    | (?P<IDENT>[A-Za-z_]\w*)
+    | (?P<FLOAT>\d+\.\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?|\d+[eE][-+]?\d+)
+    | (?P<INT>\d+)
+    | (?P<LPAREN>\()
+    | (?P<RPAREN>\))
+    | (?P<COMMA>,)
+    | (?P<ERROR>\S)
+    )""", re.VERBOSE | re.ASCII)
+
+_ident_pattern = re.compile(r'[A-Za-z_]\w*\Z', re.ASCII)
+
+
+class ParseError(ValueError):
+    """Raised when a string does not represent a valid expression"""
+    def __init__(self, message, pos=None):
+        if pos is not None:
+            message = '%s at position %d' % (message, pos)
+        super(ParseError, self).__init__(message)
+        self.pos = pos
+
+
+# split a string into (type, text, pos) tuples in a single pass, used by the parser
+# characters which do not start a token come out as 'ERROR' tokens
+@_timed('scan')
+def _scan(string):
+    return [(match.lastgroup, match.group(match.lastgroup), match.start(match.lastgroup))
+            for match in _token_pattern.finditer(string)]
+
+
+# split a string into typed tokens
+# returns a list of Token's, whitespace is skipped
+def scan(string):
+    tokens = []
+    for kind, text, pos in _scan(string):
+        if kind == 'ERROR':
+            raise ParseError('Unexpected character %r' % text, pos)
+        tokens.append(Token(kind, text, pos))
+    return tokens
+
 
 # split a string into mathematical tokens
 # returns a list of numbers, operators, parantheses and commas
 # output will not contain spaces
 def tokenize(string):
-    splitchars = list("+-*/(),%")
-    # surround any splitchar by spaces
-    tokenstring = []
-    for c in string:
-        if c in splitchars:
-            tokenstring.append(' %s ' % c)
-        else:
-            tokenstring.append(c)
-    tokenstring = ''.join(tokenstring)
-    # split on spaces: this gives us our tokens
-    tokens = tokenstring.split()
-    # special casing for ** and //
-    ans = []
-    for t in tokens:
-        if len(ans) > 0 and t == ans[-1] == '*':
-            ans[-1] = '**'
-        elif len(ans) > 0 and t == ans[-1] == '/':
-            ans[-1] = '//'
-        #elif len(ans) > 0 and t == ans[-1] == '=':
-        #    ans[-1] = '=='
-        else:
-            ans.append(t)
-    return ans
+    return [token.text for token in scan(string)]
 
 
 # check if a string represents a numeric value
@@ -59,11 +215,7 @@ def isint(string):
 
 # check if a string represents a variable
 def isvar(string):
-    try:
-        str(string)
-        return True
-    except ValueError:
-        return False
+    return _ident_pattern.match(string) is not None
 
 
 # check precedence
@@ -86,13 +238,815 @@ def assoc(token):
         return(1)
 
 
+# the Python function belonging to every operator symbol
+operators = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '**': operator.pow,
+    '%': operator.mod,
+    '//': operator.floordiv,
+    '==': operator.eq,
+}
+
+
+# Brent's method: find a root of f between a and b, where f(a) and f(b) differ in sign
+# returns the root, the function value at the root and the number of iterations
+def brent(f, a, b, fa=None, fb=None, tol=1e-12, maxiter=100):
+    if fa is None:
+        fa = f(a)
+    if fb is None:
+        fb = f(b)
+    if fa == 0:
+        return a, fa, 0
+    if fb == 0:
+        return b, fb, 0
+    if fa * fb > 0:
+        raise ValueError('f(a) and f(b) must have different signs')
+    # b is the best estimate so far, c the opposite end of the bracket
+    # and a the previous estimate
+    c, fc = b, fb
+    d = e = b - a
+    for iteration in range(1, maxiter + 1):
+        if fb * fc > 0:
+            c, fc = a, fa
+            d = e = b - a
+        if abs(fc) < abs(fb):
+            a, b, c = b, c, b
+            fa, fb, fc = fb, fc, fb
+        tol1 = 4.4e-16 * abs(b) + 0.5 * tol
+        xm = 0.5 * (c - b)
+        if abs(xm) <= tol1 or fb == 0:
+            return b, fb, iteration
+        if abs(e) >= tol1 and abs(fa) > abs(fb):
+            # try inverse quadratic interpolation, or the secant method
+            s = fb / fa
+            if a == c:
+                p = 2 * xm * s
+                q = 1 - s
+            else:
+                q = fa / fc
+                r = fb / fc
+                p = s * (2 * xm * q * (q - r) - (b - a) * (r - 1))
+                q = (q - 1) * (r - 1) * (s - 1)
+            if p > 0:
+                q = -q
+            p = abs(p)
+            if 2 * p < min(3 * xm * q - abs(tol1 * q), abs(e * q)):
+                e = d
+                d = p / q
+            else:
+                # interpolation failed, fall back to bisection
+                d = e = xm
+        else:
+            d = e = xm
+        a, fa = b, fb
+        if abs(d) > tol1:
+            b += d
+        else:
+            b += math.copysign(tol1, xm)
+        fb = f(b)
+    return b, fb, maxiter
+
+
+# bisection: find a root of f between a and b, where f(a) and f(b) differ in sign
+# returns the root, the function value at the root and the number of iterations
+def bisect(f, a, b, fa=None, fb=None, tol=1e-12, maxiter=100):
+    if fa is None:
+        fa = f(a)
+    if fb is None:
+        fb = f(b)
+    if fa == 0:
+        return a, fa, 0
+    if fb == 0:
+        return b, fb, 0
+    if fa * fb > 0:
+        raise ValueError('f(a) and f(b) must have different signs')
+    for iteration in range(1, maxiter + 1):
+        m = 0.5 * (a + b)
+        fm = f(m)
+        if fm == 0 or 0.5 * (b - a) <= tol:
+            return m, fm, iteration
+        # only the midpoint is evaluated, f(a) and f(b) are kept from earlier iterations
+        if fa * fm < 0:
+            b, fb = m, fm
+        else:
+            a, fa = m, fm
+    return m, fm, maxiter
+
+
+# approximate the derivative of f by central differences
+def difference(f):
+    def df(value):
+        h = 1e-7 * max(1.0, abs(value))
+        return (f(value + h) - f(value - h)) / (2 * h)
+    return df
+
+
+# Newton's method safeguarded by bisection: find a root of f between a and b,
+# where f(a) and f(b) differ in sign and df is the derivative of f
+# returns the root, the function value at the root and the number of iterations
+def newton(f, df, a, b, fa=None, fb=None, tol=1e-12, maxiter=100):
+    if fa is None:
+        fa = f(a)
+    if fb is None:
+        fb = f(b)
+    if fa == 0:
+        return a, fa, 0
+    if fb == 0:
+        return b, fb, 0
+    if fa * fb > 0:
+        raise ValueError('f(a) and f(b) must have different signs')
+    # orient the bracket so that f(lo) < 0 < f(hi)
+    if fa < 0:
+        lo, hi = a, b
+    else:
+        lo, hi = b, a
+    root = 0.5 * (a + b)
+    dxold = dx = abs(b - a)
+    froot = f(root)
+    dfroot = df(root)
+    for iteration in range(1, maxiter + 1):
+        if froot == 0:
+            return root, froot, iteration
+        if ((root - hi) * dfroot - froot) * ((root - lo) * dfroot - froot) > 0 \
+        or abs(2 * froot) > abs(dxold * dfroot):
+            # the Newton step leaves the bracket or converges too slowly: bisect
+            dxold = dx
+            dx = 0.5 * (hi - lo)
+            root = lo + dx
+        else:
+            dxold = dx
+            dx = froot / dfroot
+            root -= dx
+        if abs(dx) <= tol:
+            return root, f(root), iteration
+        froot = f(root)
+        dfroot = df(root)
+        if froot < 0:
+            lo = root
+        else:
+            hi = root
+    return root, froot, maxiter
+
+
+# check if a parabola through f0, fm and f1 (sampled at equal distances)
+# has its extremum in between the samples and reaches (nearly) zero there
+def dips(f0, fm, f1):
+    curvature = f0 - 2 * fm + f1
+    if curvature == 0 or curvature * fm < 0:
+        return False
+    slope = 0.5 * (f1 - f0)
+    if abs(slope) > abs(curvature):
+        return False
+    vertex = fm - slope * slope / (2 * curvature)
+    return vertex * fm <= 0 or abs(vertex) <= 0.5 * min(abs(f0), abs(fm), abs(f1))
+
+
+# find all roots of f between a and b, roots closer together than epsilon are reported once
+# f is sampled on a coarse grid first, only segments with a sign change or a dip
+# towards zero are subdivided further; with an enclosure (a function which returns an
+# interval enclosing the values of f between two points, see evaluate_interval) exactly
+# the segments whose enclosure contains zero are, and the others are proven to have no root
+def isolate_roots(f, a, b, epsilon=0.01, segments=64, enclosure=None):
+    if a > b:
+        a, b = b, a
+    n = max(1, min(segments, math.ceil(min((b - a) / epsilon, segments))))
+    if math.isfinite(b - a):
+        xs = [a + (b - a) * i / n for i in range(n)] + [b]
+    else:
+        # bounds near the largest floats, too far apart to subtract
+        xs = [a * (1 - i / n) + b * (i / n) for i in range(n)] + [b]
+    fs = [f(x) for x in xs]
+    roots = [x for x, fx in zip(xs, fs) if fx == 0]
+    stack = [(xs[i], xs[i + 1], fs[i], fs[i + 1]) for i in reversed(range(n))]
+    while stack:
+        x0, x1, f0, f1 = stack.pop()
+        if enclosure is not None and not _contains_zero(enclosure(x0, x1)):
+            continue
+        if f0 * f1 < 0 and x1 - x0 <= epsilon:
+            root, froot, iterations = brent(f, x0, x1, f0, f1)
+            # brent narrows the bracket far below epsilon, where a root has a much smaller
+            # function value than the ends of the segment; a pole or a jump does not
+            if abs(froot) <= 1e-3 * max(abs(f0), abs(f1)):
+                roots.append(root)
+            continue
+        xm = 0.5 * x0 + 0.5 * x1
+        fm = f(xm)
+        if x1 - x0 <= epsilon:
+            # a narrow segment without a sign change: look for a root touching zero
+            if fm == 0:
+                roots.append(xm)
+            elif fm * f0 < 0:
+                stack.append((xm, x1, fm, f1))
+                stack.append((x0, xm, f0, fm))
+            elif dips(f0, fm, f1):
+                slope = 0.5 * (f1 - f0)
+                curvature = f0 - 2 * fm + f1
+                xv = xm - 0.5 * (x1 - x0) * slope / curvature
+                fv = f(xv)
+                if fv == 0 or abs(fv) <= 1e-3 * max(abs(f0), abs(f1)):
+                    roots.append(xv)
+                elif fv * f0 < 0:
+                    stack.append((xv, x1, fv, f1))
+                    stack.append((x0, xv, f0, fv))
+            continue
+        if fm == 0:
+            roots.append(xm)
+        if enclosure is not None or f0 * f1 < 0 or f0 * fm < 0 or fm * f1 < 0 or dips(f0, fm, f1) \
+        or math.isnan(f0) != math.isnan(f1) or fm == 0:
+            stack.append((xm, x1, fm, f1))
+            stack.append((x0, xm, f0, fm))
+    return unique_roots(roots, epsilon)
+
+
+# sort roots and remove the ones which were found more than once, that is closer than epsilon to the previous one
+def unique_roots(roots, epsilon):
+    ans = []
+    for root in sorted(roots):
+        if len(ans) == 0 or root - ans[-1] > epsilon:
+            ans.append(root)
+    return ans
+
+
+# polynomials, used to solve polynomial expressions directly: a polynomial is a list of
+# exact coefficients (Fractions or ints), lowest degree first, without trailing zeros,
+# so the zero polynomial is []
+
+# the highest degree Expression.polynomial expands to
+_max_degree = 64
+
+
+# the float value as an int if it is integral, as a Fraction otherwise
+def _exact(value):
+    value = float(value)
+    return int(value) if value.is_integer() else fractions.Fraction(value)
+
+
+def _poly_trim(p):
+    while p and p[-1] == 0:
+        p.pop()
+    return p
+
+
+def _poly_add(p, q):
+    if len(p) < len(q):
+        p, q = q, p
+    ans = list(p)
+    for i, c in enumerate(q):
+        ans[i] += c
+    return _poly_trim(ans)
+
+
+def _poly_neg(p):
+    return [-c for c in p]
+
+
+def _poly_mul(p, q):
+    if not p or not q:
+        return []
+    ans = [0] * (len(p) + len(q) - 1)
+    for i, c in enumerate(p):
+        if c:
+            for j, d in enumerate(q):
+                ans[i + j] += c * d
+    return ans
+
+
+def _poly_derivative(p):
+    return [i * c for i, c in enumerate(p)][1:]
+
+
+# long division of the integer polynomial p by q, in integers: returns the quotient
+# and the remainder, both multiplied by the same positive number
+def _poly_divmod(p, q):
+    quotient = [0] * max(0, len(p) - len(q) + 1)
+    remainder = [c * abs(q[-1]) ** len(quotient) for c in p]
+    for i in reversed(range(len(quotient))):
+        c = remainder[i + len(q) - 1] // q[-1]
+        quotient[i] = c
+        for j, d in enumerate(q):
+            remainder[i + j] -= c * d
+    return quotient, _poly_trim(remainder[:len(q) - 1])
+
+
+# the positive multiple of p with coprime integer coefficients, which has the same signs
+def _poly_primitive(p):
+    if not p:
+        return p
+    denominator = math.lcm(*[c.denominator for c in p])
+    ints = [c.numerator * (denominator // c.denominator) for c in p]
+    divisor = math.gcd(*ints)
+    return [c // divisor for c in ints]
+
+
+def _poly_gcd(p, q):
+    while q:
+        p, q = q, _poly_primitive(_poly_divmod(p, q)[1])
+    return p
+
+
+# the value of the integer polynomial p at the float x, as a numerator with the exact
+# sign and a positive denominator
+def _poly_ratio(p, x):
+    n, d = x.as_integer_ratio()
+    value = 0
+    power = 1
+    for c in reversed(p):
+        value = value * n + c * power
+        power *= d
+    return value, power // d if p else 1
+
+
+# the square root of a positive Fraction as a float; the Fraction itself may be
+# far outside the range of floats, like the discriminant of large coefficients
+def _fraction_sqrt(x):
+    shift = (x.numerator.bit_length() - x.denominator.bit_length()) // 2
+    try:
+        return math.ldexp(math.sqrt(x / fractions.Fraction(4) ** shift), shift)
+    except OverflowError:
+        return math.inf
+
+
+# the value of the integer polynomial p at the float x, correctly rounded
+def _poly_value(p, x):
+    numerator, denominator = _poly_ratio(p, x)
+    try:
+        return numerator / denominator
+    except OverflowError:
+        return math.inf if numerator > 0 else -math.inf
+
+
+# the Sturm sequence of the square-free integer polynomial p, each scaled to be primitive
+def _sturm_chain(p):
+    chain = [p, _poly_primitive(_poly_derivative(p))]
+    while True:
+        remainder = _poly_divmod(chain[-2], chain[-1])[1]
+        if not remainder:
+            return chain
+        chain.append(_poly_primitive(_poly_neg(remainder)))
+
+
+# the number of sign changes in the Sturm sequence at x, and the sign of the polynomial itself;
+# the number of distinct roots in (lo, hi] is the number at lo minus the number at hi
+def _sturm_signs(chain, x):
+    changes = 0
+    last = 0
+    first = None
+    for p in chain:
+        value = _poly_ratio(p, x)[0]
+        sign = (value > 0) - (value < 0)
+        if first is None:
+            first = sign
+        if sign:
+            if last and sign != last:
+                changes += 1
+            last = sign
+    return changes, first
+
+
+# the root of the integer polynomial p between lo and hi, where p has the exact sign
+# slo at lo and the opposite one at hi, bisected on exact signs until lo and hi are
+# neighbouring floats (about 2100 steps at most); values in floats would underflow
+# or overflow far from 1, and Brent's method would stop at wrong roots
+def _poly_bisect(p, lo, hi, slo):
+    while True:
+        # halves first, lo + hi may overflow
+        mid = 0.5 * lo + 0.5 * hi
+        if not lo < mid < hi:
+            # the end with the smaller value, compared exactly
+            nlo, dlo = _poly_ratio(p, lo)
+            nhi, dhi = _poly_ratio(p, hi)
+            return lo if abs(nlo) * dhi <= abs(nhi) * dlo else hi
+        value = _poly_ratio(p, mid)[0]
+        if value == 0:
+            return mid
+        if (value > 0) == (slo > 0):
+            lo = mid
+        else:
+            hi = mid
+
+
+# the distinct real roots of the polynomial p of degree 3 or more between a and b:
+# the roots of its square-free part are isolated with a Sturm sequence, in segments
+# with a sign change, which are then refined by bisection
+def _sturm_roots(p, a, b):
+    squarefree = _poly_primitive(_poly_divmod(p, _poly_gcd(p, _poly_derivative(p)))[0])
+    chain = _sturm_chain(squarefree)
+    va, sa = _sturm_signs(chain, a)
+    vb, sb = _sturm_signs(chain, b)
+    roots = [a] if sa == 0 else []
+    stack = [(a, b, va, vb, sa, sb)]
+    while stack:
+        lo, hi, vlo, vhi, slo, shi = stack.pop()
+        count = vlo - vhi
+        if count == 0:
+            continue
+        if count == 1 and shi == 0:
+            roots.append(hi)
+            continue
+        if count == 1 and slo * shi < 0:
+            roots.append(_poly_bisect(squarefree, lo, hi, slo))
+            continue
+        mid = 0.5 * lo + 0.5 * hi
+        if not lo < mid < hi:
+            # the roots are closer together than floats can tell apart
+            roots.append(mid)
+            continue
+        vmid, smid = _sturm_signs(chain, mid)
+        stack.append((mid, hi, vmid, vhi, smid, shi))
+        stack.append((lo, mid, vlo, vmid, slo, smid))
+    return sorted(roots)
+
+
+# find the distinct real roots of the polynomial with the given coefficients (lowest
+# degree first) between a and b, as a sorted list of floats; in closed form up to
+# degree 2, with a Sturm sequence above that, from the exact values of the coefficients
+def polynomial_roots(coefficients, a=-1000, b=1000):
+    if a > b:
+        a, b = b, a
+    p = _poly_trim([fractions.Fraction(c) for c in coefficients])
+    if not p:
+        raise ValueError('Every number is a root of the zero polynomial')
+    if len(p) == 1:
+        roots = []
+    elif len(p) == 2:
+        roots = [float(-p[0] / p[1])]
+    elif len(p) == 3:
+        c, b1, a2 = p
+        discriminant = b1 * b1 - 4 * a2 * c
+        if discriminant < 0:
+            roots = []
+        elif discriminant == 0:
+            roots = [float(-b1 / (2 * a2))]
+        else:
+            # the stable form, which avoids cancellation between -b1 and the square root
+            q = -(0.5 * float(b1) + math.copysign(0.5 * _fraction_sqrt(discriminant), b1))
+            if q == 0 or not math.isfinite(q):
+                # roots too close to zero or too large for floats
+                return _sturm_roots(_poly_primitive(p), float(a), float(b))
+            roots = sorted([q / float(a2), float(c) / q])
+    else:
+        return _sturm_roots(_poly_primitive(p), float(a), float(b))
+    return [root for root in roots if a <= root <= b]
+
+
+# interval arithmetic, used by evaluate_interval: an interval is a (lo, hi) tuple of floats
+# which encloses every real value a subexpression takes, or None if it takes none at all
+# (it is undefined or not real everywhere); computed bounds are rounded outwards, so
+# the enclosure still holds with rounding errors
+
+def _interval(lo, hi):
+    if math.isnan(lo) or math.isnan(hi):
+        return (-math.inf, math.inf)
+    return (math.nextafter(lo, -math.inf), math.nextafter(hi, math.inf))
+
+
+def _contains_zero(interval):
+    return interval is not None and interval[0] <= 0 <= interval[1]
+
+
+def _interval_add(x, y):
+    return _interval(x[0] + y[0], x[1] + y[1])
+
+
+def _interval_sub(x, y):
+    return _interval(x[0] - y[1], x[1] - y[0])
+
+
+# a product of bounds, where zero times infinity is zero
+def _product(a, b):
+    if a == 0 or b == 0:
+        return 0.0
+    return a * b
+
+
+def _interval_mul(x, y):
+    products = [_product(a, b) for a in x for b in y]
+    return _interval(min(products), max(products))
+
+
+def _interval_div(x, y):
+    c, d = y
+    if c > 0 or d < 0:
+        reciprocal = _interval(1 / d, 1 / c)
+    elif c == 0 and d > 0:
+        reciprocal = (math.nextafter(1 / d, -math.inf), math.inf)
+    elif c < 0 and d == 0:
+        reciprocal = (-math.inf, math.nextafter(1 / c, math.inf))
+    elif c == d == 0:
+        # division by zero everywhere
+        return None
+    else:
+        return (-math.inf, math.inf)
+    return _interval_mul(x, reciprocal)
+
+
+# a power of bounds, where overflow and zero to a negative power give infinity
+def _power(base, exponent):
+    try:
+        return float(base ** exponent)
+    except OverflowError:
+        if base < 0 and exponent % 2 == 1:
+            return -math.inf
+        return math.inf
+    except ZeroDivisionError:
+        return math.inf
+
+
+def _interval_pow(x, y):
+    a, b = x
+    c, d = y
+    if c == d and math.isfinite(c) and c == int(c):
+        n = int(c)
+        if n == 0:
+            return (1.0, 1.0)
+        if n < 0:
+            return _interval_div((1.0, 1.0), _interval_pow(x, (-n, -n)))
+        if n % 2 == 1 or a >= 0:
+            return _interval(_power(a, n), _power(b, n))
+        if b <= 0:
+            return _interval(_power(b, n), _power(a, n))
+        return _interval(0.0, max(_power(a, n), _power(b, n)))
+    if a < 0:
+        # a negative base only has real powers for integer exponents
+        if c != d and (math.isinf(c) or math.isinf(d) or math.floor(d) >= c):
+            return (-math.inf, math.inf)
+        if b < 0:
+            return None
+        a = 0.0
+    # x ** y is monotonic in x and in y, so the extremes are in the corners
+    corners = [_power(p, q) for p in (a, b) for q in (c, d)]
+    return _interval(min(corners), max(corners))
+
+
+def _interval_floordiv(x, y):
+    quotient = _interval_div(x, y)
+    if quotient is None:
+        return None
+    return tuple(float(math.floor(bound)) if math.isfinite(bound) else bound for bound in quotient)
+
+
+def _interval_mod(x, y):
+    a, b = x
+    c, d = y
+    if c == d:
+        if c == 0:
+            return None
+        # within one period x % c grows with x; a % c is fmod(a, c), which is exact,
+        # plus c when the signs differ, which is rounded once; when a and b lie in
+        # different periods, the exact remainder of b is below the one of a
+        if math.isfinite(a) and math.isfinite(b):
+            lo, hi = a % c, b % c
+            if a == b or lo < hi and b - a < abs(c):
+                lo, hi = _interval(lo, hi)
+                return (max(lo, 0.0), min(hi, c)) if c > 0 else (max(lo, c), min(hi, 0.0))
+        return (0.0, c) if c > 0 else (c, 0.0)
+    # the result has the sign of the divisor and is smaller in size
+    if c >= 0:
+        return (0.0, d)
+    if d <= 0:
+        return (c, 0.0)
+    return (c, d)
+
+
+def _interval_eq(x, y):
+    if x[0] == x[1] == y[0] == y[1]:
+        return (1.0, 1.0)
+    if x[1] < y[0] or y[1] < x[0]:
+        return (0.0, 0.0)
+    return (0.0, 1.0)
+
+
+# whether an operator is defined everywhere on the intervals x and y and has no jumps there
+def _smooth(op_symbol, x, y):
+    if op_symbol == '/':
+        return not y[0] <= 0 <= y[1]
+    if op_symbol == '**':
+        if y[0] == y[1] and math.isfinite(y[0]) and y[0] == int(y[0]):
+            return y[0] >= 0 or not x[0] <= 0 <= x[1]
+        return x[0] > 0 or x[0] == 0 and y[0] > 0
+    return op_symbol in ('+', '-', '*')
+
+
+_interval_operators = {
+    '+': _interval_add,
+    '-': _interval_sub,
+    '*': _interval_mul,
+    '/': _interval_div,
+    '**': _interval_pow,
+    '%': _interval_mod,
+    '//': _interval_floordiv,
+    '==': _interval_eq,
+}
+
+
+class RootResult(float):
+    """A root found by findRoot: a float which also carries how it was found"""
+    def __new__(cls, root, residual, iterations, evaluations, converged, method):
+        self = super(RootResult, cls).__new__(cls, root)
+        # the function value at the root
+        self.residual = residual
+        self.iterations = iterations
+        # the number of times the expression was evaluated
+        self.evaluations = evaluations
+        self.converged = converged
+        self.method = method
+        return self
+
+
+# table of canonical nodes while interning is enabled, None otherwise
+_interned = None
+
+
+# the key of a node in the interning table: the children of an operator by identity,
+# since they are canonical nodes themselves, and leaves by type and value; a float keeps
+# its sign, so Constant(0.0) and Constant(-0.0) stay apart, as do Constant(2) and Constant(2.0)
+def _interning_key(cls, args):
+    key = [cls]
+    for arg in args:
+        if isinstance(arg, Expression):
+            key.append(id(arg))
+        elif isinstance(arg, float):
+            key.append((float, arg, math.copysign(1.0, arg)))
+        else:
+            key.append((type(arg), arg))
+    return tuple(key)
+
+
+# enable or disable interning, returns whether interning was enabled before
+# while interning is enabled, constructing a node equal to an existing node returns
+# that existing node, so equal subtrees share memory and compare equal in O(1)
+def set_interning(enabled=True):
+    global _interned
+    previous = _interned is not None
+    if enabled and _interned is None:
+        _interned = weakref.WeakValueDictionary()
+    elif not enabled:
+        _interned = None
+    return previous
+
+
+# intern all nodes constructed within a with-block
+@contextlib.contextmanager
+def interning(enabled=True):
+    previous = set_interning(enabled)
+    try:
+        yield
+    finally:
+        set_interning(previous)
+
+
+class ParseCache():
+    """A bounded, thread-safe cache of parsed expressions, which evicts the least recently used entry"""
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, string, parse):
+        "Return the cached expression for string, or parse it with parse(string) and cache the result"
+        with self._lock:
+            expr = self._entries.get(string)
+            if expr is not None:
+                self._entries.move_to_end(string)
+                self.hits += 1
+                if _instrumentation is not None:
+                    _instrumentation.count('cache hits')
+                return expr
+            self.misses += 1
+        if _instrumentation is not None:
+            _instrumentation.count('cache misses')
+        # parse outside the lock, so other threads are not kept waiting
+        expr = parse(string)
+        with self._lock:
+            self._entries[string] = expr
+            self._entries.move_to_end(string)
+            self._evict()
+        return expr
+
+    def resize(self, maxsize):
+        "Change the maximum number of cached expressions, 0 disables the cache"
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        "Remove all cached expressions and reset the counters"
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        "Return the counters and the size of the cache as a dictionary"
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self._entries), 'maxsize': self.maxsize}
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+# the cache used by Expression.fromString
+parse_cache = ParseCache()
+
+
+# marker used by Expression.postorder
+_exit = object()
+
+
+# a difference found by Expression.compare: the path of the node from the root (a tuple
+# of 'lhs' and 'rhs'), its kind ('operator', 'constant', 'variable' or 'structure' when a
+# leaf meets an operator or a Constant a Variable), and what was found on both sides: the
+# operators, the values, the names or (for 'structure') the subtrees
+Difference = collections.namedtuple('Difference', ['path', 'kind', 'left', 'right'])
+
+
+class Comparison():
+    """The result of Expression.compare: where two expression trees agree and where they differ
+
+    same holds the paths (tuples of 'lhs' and 'rhs') of the largest subtrees which are equal on both sides,
+    differences a Difference for every operator, constant or variable which is
+    not. Below a differing operator the operands are compared as well.
+    """
+    def __init__(self, same, differences):
+        # paths are kept as linked (parent, step) pairs while comparing, as tuples they
+        # would be copied at every level; same is converted when it is first needed
+        self._same = same
+        self.differences = [d._replace(path=_path(d.path)) for d in differences]
+
+    @property
+    def same(self):
+        if not isinstance(self._same, tuple):
+            self._same = tuple(_path(link) for link in self._same)
+        return self._same
+
+    @property
+    def equal(self):
+        return len(self.differences) == 0
+
+    @property
+    def operators_equal(self):
+        return not any(d.kind in ('operator', 'structure') for d in self.differences)
+
+    @property
+    def constants_equal(self):
+        return not any(d.kind in ('constant', 'structure') for d in self.differences)
+
+    @property
+    def variables_equal(self):
+        return not any(d.kind in ('variable', 'structure') for d in self.differences)
+
+    def __str__(self):
+        if self.equal:
+            return 'equal'
+        return '\n'.join('%s: %s %s != %s' % ('.'.join(d.path) or 'root', d.kind, d.left, d.right)
+                         for d in self.differences)
+
+
+# turn a linked path (parent, step) from Expression.compare into a tuple of steps
+def _path(link):
+    steps = []
+    while link is not None:
+        link, step = link
+        steps.append(step)
+    steps.reverse()
+    return tuple(steps)
+
+
 class Expression():
     """A mathematical expression, represented as an expression tree"""
     """
     Any concrete subclass of Expression should have these methods:
      - __str__(): return a string representation of the Expression.
      - __eq__(other): tree-equality, check if other represents the same expression tree.
+    Expressions are immutable, so (parts of) trees can safely be shared.
     """
+    # no __dict__ per node: the structural hash, the compiled function (set on demand)
+    # and a weak reference slot for the interning table
+    __slots__ = ('_hash', '_compiled', '__weakref__')
+
+    def __new__(cls, *args):
+        if _interned is None:
+            return object.__new__(cls)
+        key = _interning_key(cls, args)
+        node = _interned.get(key)
+        if node is None:
+            node = super(Expression, cls).__new__(cls)
+            _interned[key] = node
+        return node
+
     # operator overloading:
     # this allows us to perform 'arithmetic' with expressions, and obtain another expression
     def __add__(self, other):
@@ -121,75 +1075,601 @@ class Expression():
         if type(self) != type(other):
             return False
 
-    # basic Shunting-yard algorithm
-    def fromString(string):
-        # split into tokens
-        tokens = tokenize(string)
-        # stack used by the Shunting-Yard algorithm
-        stack = []
-        # output of the algorithm: a list representing the formula in RPN
-        # this will contain Constant's and '+'s
-        output = []
-        # list of operators
-        oplist = ['+', '-', '*', '/', '**', '%', '//']
-        for token in tokens:
-            if isnumber(token):
-                # numbers go directly to the output
-                if isint(token):
-                    output.append(Constant(int(token)))
+    # the structural hash is computed once, when the node is constructed
+    def __hash__(self):
+        return self._hash
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Expressions are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Expressions are immutable')
+
+    # traversal helpers: none of these recurse, so they work on trees of any depth;
+    # besides the values they produce they only keep a stack as deep as the tree
+
+    def postorder(self):
+        "Iterate over the nodes of the tree, every node after its operands"
+        stack = [self]
+        pop = stack.pop
+        while stack:
+            node = pop()
+            if node is _exit:
+                # all operands of the node below the marker have been yielded
+                yield pop()
+            elif isinstance(node, BinaryNode):
+                stack.extend((node, _exit, node.rhs, node.lhs))
+            else:
+                yield node
+
+    def fold(self, leaf, binary):
+        "Combine the tree bottom-up: leaf(node) for Constants and Variables, binary(node, lhs, rhs) for operators"
+        values = []
+        for node in self.postorder():
+            if isinstance(node, BinaryNode):
+                rhs = values.pop()
+                values[-1] = binary(node, values[-1], rhs)
+            else:
+                values.append(leaf(node))
+        return values[0]
+
+    def accept(self, visitor):
+        "Let a Visitor combine the tree bottom-up"
+        return visitor.visit(self)
+
+    def copy(self):
+        "Return a new tree equal to this one"
+        return self.fold(lambda node: node._copy(),
+                         lambda node, lhs, rhs: type(node)(lhs, rhs))
+
+    # expressions are immutable, so a shallow copy is the expression itself
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def compare(self, other):
+        "Compare the expression tree with another one, return a Comparison"
+        # the structural hash of every node serves as the fingerprint of its subtree:
+        # subtrees with different fingerprints differ, equal ones are confirmed with ==
+        # (hashes collide) and are then not searched for differences
+        same = []
+        differences = []
+        stack = [(self, other, None)]
+        while stack:
+            a, b, path = stack.pop()
+            if a is b or a._hash == b._hash and a == b:
+                same.append(path)
+            elif isinstance(a, BinaryNode) and isinstance(b, BinaryNode):
+                if a.op_symbol != b.op_symbol:
+                    differences.append(Difference(path, 'operator', a.op_symbol, b.op_symbol))
+                stack.append((a.rhs, b.rhs, (path, 'rhs')))
+                stack.append((a.lhs, b.lhs, (path, 'lhs')))
+            elif isinstance(a, Constant) and isinstance(b, Constant):
+                differences.append(Difference(path, 'constant', a.value, b.value))
+            elif isinstance(a, Variable) and isinstance(b, Variable):
+                differences.append(Difference(path, 'variable', a.variable, b.variable))
+            else:
+                differences.append(Difference(path, 'structure', a, b))
+        return Comparison(same, differences)
+
+    def compare_many(self, others):
+        "Compare the expression tree with every expression in others, return a list of Comparisons"
+        # equal expressions are common in a library of formulas, each distinct one is compared once
+        results = {}
+        ans = []
+        for other in others:
+            comparison = results.get(other)
+            if comparison is None:
+                comparison = results[other] = self.compare(other)
+            ans.append(comparison)
+        return ans
+
+    def flatten(self):
+        "Return the expression as a FlatExpression"
+        return FlatExpression.from_expression(self)
+
+    def dumps(self):
+        "Encode the expression in a compact binary format, see FlatExpression.dumps"
+        return self.flatten().dumps()
+
+    def loads(data):
+        "Decode an expression written by dumps"
+        return FlatExpression.loads(data).to_expression()
+
+    def variables(self):
+        "Return the set of variable names used in the expression"
+        names = set()
+        seen = set()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            # shared subtrees are visited once
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            if isinstance(node, Variable):
+                names.add(node.variable)
+            elif isinstance(node, BinaryNode):
+                stack.append(node.lhs)
+                stack.append(node.rhs)
+        return names
+
+    @_timed('compile')
+    def compile(self):
+        "Compile the expression into a single Python function with the variables as arguments"
+        # the function is built once and cached on the node
+        try:
+            return self._compiled
+        except AttributeError:
+            pass
+        names = sorted(self.variables())
+        # variables become the arguments of the function, names which are no valid
+        # identifiers (or could clash with our temporaries) are replaced
+        args = {}
+        for i, name in enumerate(names):
+            if name.isidentifier() and not keyword.iskeyword(name) and not name.startswith('_'):
+                args[name] = name
+            else:
+                args[name] = '_v%d' % i
+        namespace = {}
+        lines = []
+        # code for every node object already seen, and the temporary holding
+        # every distinct operation, so shared or repeated subtrees are computed once
+        done = {}
+        temps = {}
+        # walk the tree in postorder with an explicit stack, every operator
+        # becomes one assignment to a temporary, so deep trees need no nesting
+        stack = [(self, False)]
+        results = []
+        while stack:
+            node, visited = stack.pop()
+            if not visited and id(node) in done:
+                results.append(done[id(node)])
+                continue
+            if isinstance(node, BinaryNode):
+                if not visited:
+                    stack.append((node, True))
+                    stack.append((node.rhs, False))
+                    stack.append((node.lhs, False))
+                    continue
+                rhs = results.pop()
+                lhs = results.pop()
+                key = (node.op_symbol, lhs, rhs)
+                temp = temps.get(key)
+                if temp is None:
+                    temp = '_t%d' % len(lines)
+                    lines.append('    %s = %s %s %s' % (temp, lhs, node.op_symbol, rhs))
+                    temps[key] = temp
+                done[id(node)] = temp
+                results.append(temp)
+            elif isinstance(node, Variable):
+                results.append(args[node.variable])
+            else:
+                # constants evaluate to floats, just like Constant.evaluate
+                value = node.evaluate()
+                if math.isfinite(value):
+                    # negative literals are parenthesized so that -2.0 ** x stays (-2.0) ** x
+                    if math.copysign(1.0, value) < 0:
+                        results.append('(%r)' % value)
+                    else:
+                        results.append(repr(value))
                 else:
-                    output.append(Constant(float(token)))
-            elif isvar(token) and token not in oplist:
-                output.append(Variable(str(token)))
-            elif token in oplist:
-                # pop operators from the stack to the output until the top is no longer an operator
-                while True:
-                    if len(stack) == 0 or stack[-1] not in oplist \
-                    or int(assoc(stack[-1])) == 0 and int(prec(stack[-1])) <= int(prec(token)) \
-                    or int(assoc(stack[-1])) == 1 and int(prec(stack[-1])) <  int(prec(token)):
-                        break
-                    output.append(stack.pop())
-                # push the new operator onto the stack
-                stack.append(token)
-            elif token == '(':
-                # left parantheses go to the stack
-                stack.append(token)
-            elif token == ')':
-                # right paranthesis: pop everything upto the last left paranthesis to the output
-                while not stack[-1] == '(':
-                    output.append(stack.pop())
-                # pop the left paranthesis from the stack (but not to the output)
-                stack.pop()
+                    name = '_c%d' % len(namespace)
+                    namespace[name] = value
+                    results.append(name)
+        lines.append('    return %s' % results.pop())
+        source = 'def _compiled(%s):\n%s\n' % (', '.join(args[n] for n in names), '\n'.join(lines))
+        exec(source, namespace)
+        function = namespace['_compiled']
+        function.variables = tuple(names)
+        function.source = source
+        object.__setattr__(self, '_compiled', function)
+        return function
+
+    @_timed('evaluate_batch')
+    def evaluate_batch(self, dic=None):
+        "Evaluate the expression for whole arrays of variable values at once, using NumPy"
+        if np is None:
+            raise ImportError('evaluate_batch requires NumPy')
+        if dic is None:
+            dic = {}
+        # the compiled function applies every operator once to the whole array;
+        # NumPy's // and % follow the same sign rules as Python's
+        function = self.compile()
+        args = [np.asarray(dic[name], dtype=float) for name in function.variables]
+        shape = np.broadcast_shapes(*[arg.shape for arg in args])
+        # where the scalar path raises (division by zero, complex powers),
+        # the batch contains inf or nan instead
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            result = np.asarray(function(*args), dtype=float)
+        if result.shape != shape:
+            # constants (or constant subtrees) are broadcast to the bindings' shape
+            result = np.broadcast_to(result, shape).copy()
+        return result
+
+    def evaluate_interval(self, dic=None):
+        """Return an interval (lo, hi) which contains the value of the expression for every choice of values
+
+        dic maps every variable to an interval (lo, hi) or a number. Rounding errors
+        are accounted for, so the enclosure is guaranteed; None means the expression
+        has no real value at all for these variables.
+        """
+        return self._evaluate_interval(dic)[0]
+
+    # evaluate_interval, which also returns whether the expression is smooth on the intervals:
+    # defined everywhere and made of operators without jumps, so the mean value theorem holds
+    def _evaluate_interval(self, dic):
+        def leaf(node):
+            if isinstance(node, Variable):
+                value = dic[node.variable]
+                if isinstance(value, (tuple, list)):
+                    lo, hi = float(value[0]), float(value[1])
+                    if lo > hi:
+                        raise ValueError('Empty interval for %s: %s' % (node.variable, value))
+                    return (lo, hi), True
+                value = node.evaluate(dic)
             else:
-                # unknown token
-                raise ValueError('Unknown token: %s' % token)
-        # pop any tokens still on the stack to the output
-        while len(stack) > 0:
-            output.append(stack.pop())
-        # convert RPN to an actual expression tree
-        for t in output:
-            if t in oplist:
-                # let eval and operator overloading take care of figuring out what to do
-                y = stack.pop()
-                x = stack.pop()
-                stack.append(eval('x %s y' % t))
+                value = node.value
+            if isinstance(value, complex):
+                return (-math.inf, math.inf), False
+            try:
+                bound = float(value)
+            except OverflowError:
+                return (-math.inf, math.inf), False
+            if bound != value:
+                # an int which is not exactly a float
+                return _interval(bound, bound), True
+            return (bound, bound), True
+        def binary(node, lhs, rhs):
+            (x, smooth_x), (y, smooth_y) = lhs, rhs
+            if x is None or y is None:
+                return None, False
+            return _interval_operators[node.op_symbol](x, y), smooth_x and smooth_y and _smooth(node.op_symbol, x, y)
+        return self.fold(leaf, binary)
+
+    def _enclosure(self, x):
+        "Return a function enclosure(lo, hi) of the single variable x, which evaluates the expression on an interval"
+        # where the expression is smooth, the mean value form f(m) + f'(X) * (X - m) is
+        # intersected with the plain interval evaluation; it is much tighter on narrow
+        # intervals, where x occurs several times (x**2 - 2*x + 1 near 1)
+        try:
+            derivative = self.diff(x)
+        except ValueError:
+            derivative = None
+        def enclosure(lo, hi):
+            try:
+                natural, smooth = self._evaluate_interval({x: (lo, hi)})
+                if not smooth or derivative is None or lo == hi:
+                    return natural
+                m = 0.5 * (lo + hi)
+                center = self.evaluate_interval({x: m})
+                slope = derivative.evaluate_interval({x: (lo, hi)})
+            except (ArithmeticError, ValueError, TypeError):
+                return (-math.inf, math.inf)
+            if center is None or slope is None:
+                return natural
+            # the derivative can contain rounded constants (log(2) for 2 ** x), allow for their error
+            slope = _interval(slope[0] - 1e-12 * abs(slope[0]), slope[1] + 1e-12 * abs(slope[1]))
+            centered = _interval_add(center, _interval_mul(slope, _interval_sub((lo, hi), (m, m))))
+            return (max(natural[0], centered[0]), min(natural[1], centered[1]))
+        return enclosure
+
+    def polynomial(self, x):
+        """Return the coefficients of the expression as a polynomial in x, lowest degree first
+
+        The coefficients are exact: ints, or Fractions of the constants' float values. Returns None
+        if the expression is not a polynomial in x: it has other variables, divides by x,
+        raises x to a power which is not a non-negative integer constant, or its degree would
+        be above _max_degree. The zero polynomial is ().
+        """
+        def leaf(node):
+            if isinstance(node, Variable):
+                return [0, 1] if node.variable == x else None
+            if isinstance(node.value, complex):
+                return None
+            try:
+                value = node.evaluate()
+            except OverflowError:
+                return None
+            if not math.isfinite(value):
+                return None
+            return _poly_trim([_exact(value)])
+        def binary(node, lhs, rhs):
+            if lhs is None or rhs is None:
+                return None
+            op_symbol = node.op_symbol
+            if op_symbol == '+':
+                return _poly_add(lhs, rhs)
+            if op_symbol == '-':
+                return _poly_add(lhs, _poly_neg(rhs))
+            if op_symbol == '*':
+                product = _poly_mul(lhs, rhs)
+                return product if len(product) <= _max_degree + 1 else None
+            if len(lhs) <= 1 and len(rhs) <= 1:
+                # both operands are constant: apply the operator to floats, like evaluate
+                try:
+                    value = operators[op_symbol](float(lhs[0]) if lhs else 0.0, float(rhs[0]) if rhs else 0.0)
+                except ArithmeticError:
+                    return None
+                if isinstance(value, complex) or not math.isfinite(value):
+                    return None
+                return _poly_trim([_exact(value)])
+            if op_symbol == '/' and len(rhs) == 1:
+                return [fractions.Fraction(c) / rhs[0] for c in lhs]
+            if op_symbol == '**' and len(rhs) <= 1:
+                exponent = rhs[0] if rhs else 0
+                if exponent.denominator == 1 and 0 <= exponent and (len(lhs) - 1) * exponent <= _max_degree:
+                    ans = [1]
+                    for i in range(int(exponent)):
+                        ans = _poly_mul(ans, lhs)
+                    return ans
+            return None
+        ans = self.fold(leaf, binary)
+        return None if ans is None else tuple(ans)
+
+    def _univariate(self, x):
+        "Return a Python function of the single variable x which evaluates the expression to a float"
+        function = self.compile()
+        others = set(function.variables) - {x}
+        if others:
+            raise ValueError('Expression has other variables than %s: %s' % (x, ', '.join(sorted(others))))
+        if len(function.variables) == 0:
+            constant = function
+            function = lambda value: constant()
+        # points where the expression is undefined or not real evaluate to nan
+        def f(value):
+            try:
+                ans = function(value)
+            except (ArithmeticError, ValueError):
+                return math.nan
+            if isinstance(ans, complex):
+                return math.nan
+            return float(ans)
+        stats = _instrumentation
+        if stats is None:
+            return f
+        # count the evaluations of the root finders which use this function
+        def counted(value):
+            stats.count('root evaluations')
+            return f(value)
+        return counted
+
+    @_timed('diff')
+    def diff(self, x):
+        "Return the derivative of the expression with respect to the variable x, as a new Expression"
+        # derivatives are computed bottom-up with an explicit stack; a subtree which
+        # occurs more than once in the tree is differentiated only once
+        derivatives = {}
+        stack = [(self, False)]
+        while stack:
+            node, visited = stack.pop()
+            if id(node) in derivatives:
+                continue
+            if isinstance(node, Constant):
+                derivatives[id(node)] = Constant(0)
+            elif isinstance(node, Variable):
+                derivatives[id(node)] = Constant(1 if node.variable == x else 0)
+            elif not visited:
+                stack.append((node, True))
+                stack.append((node.rhs, False))
+                stack.append((node.lhs, False))
             else:
-                # a constant, push it to the stack
-                stack.append(t)
-        # the resulting expression tree is what's left on the stack
-        return stack[0]
+                u, v = node.lhs, node.rhs
+                du, dv = derivatives[id(u)], derivatives[id(v)]
+                if isinstance(node, AddNode):
+                    ans = _add(du, dv)
+                elif isinstance(node, SubNode):
+                    ans = _sub(du, dv)
+                elif isinstance(node, MulNode):
+                    ans = _add(_mul(du, v), _mul(u, dv))
+                elif isinstance(node, TrueDivNode):
+                    ans = _div(_sub(_mul(du, v), _mul(u, dv)), _pow(v, Constant(2)))
+                elif isinstance(node, PowNode):
+                    if _isconstant(dv, 0):
+                        # power rule
+                        ans = _mul(_mul(v, _pow(u, _sub(v, Constant(1)))), du)
+                    elif isinstance(u, Constant) and u.value > 0:
+                        # exponential with a constant base
+                        ans = _mul(_mul(node, Constant(math.log(u.value))), dv)
+                    else:
+                        raise ValueError('Cannot differentiate %s: both base and exponent depend on %s' % (node, x))
+                elif isinstance(node, ModNode):
+                    # u % v == u - v * (u // v), and u // v is piecewise constant
+                    ans = _sub(du, _mul(dv, FloorDivNode(u, v)))
+                elif isinstance(node, FloorDivNode):
+                    ans = Constant(0)
+                else:
+                    raise ValueError('Cannot differentiate %s' % node)
+                derivatives[id(node)] = ans
+        return derivatives[id(self)]
+
+    @_timed('simplify')
+    def simplify(self):
+        "Return an equivalent, smaller expression: constants folded, identities applied and like terms collected"
+        # like terms are collected once per chain of + and - (or of *), at its top node;
+        # first find the nodes which are part of a longer chain
+        inner = set()
+        for node in self.postorder():
+            for chain in (_sum_nodes, _product_nodes):
+                if isinstance(node, chain):
+                    for operand in (node.lhs, node.rhs):
+                        if isinstance(operand, chain):
+                            inner.add(id(operand))
+
+        def binary(node, lhs, rhs):
+            builder = _builders.get(type(node))
+            if builder is not None:
+                ans = builder(lhs, rhs)
+            elif isinstance(lhs, Constant) and isinstance(rhs, Constant):
+                ans = _fold(lhs, rhs, node.op_symbol) or type(node)(lhs, rhs)
+            elif lhs is node.lhs and rhs is node.rhs:
+                ans = node
+            else:
+                ans = type(node)(lhs, rhs)
+            if id(node) not in inner:
+                if isinstance(ans, _sum_nodes):
+                    ans = _collect_sum(ans)
+                elif isinstance(ans, _product_nodes):
+                    ans = _collect_product(ans)
+            return ans
+
+        return self.fold(lambda node: node, binary)
+
+    @_timed('fromString')
+    def fromString(string):
+        "Parse a string into an expression tree, repeated strings are served from parse_cache"
+        # the cached trees are not interned, while interning every tree has to be canonical
+        if _interned is not None:
+            return Expression.parseString(string)
+        return parse_cache.lookup(string, Expression.parseString)
+
+    # precedence climbing without recursion: operands go on one stack, operators waiting
+    # for their right operand (and open parentheses) on another; an operator is applied
+    # as soon as the next operator may not become part of its right operand
+    @_timed('parse')
+    def parseString(string):
+        "Parse a string into an expression tree, without the parse cache"
+        # tuples of the groups of _token_pattern, only the group of the token's kind is
+        # not empty; an empty tuple marks the end
+        stats = _instrumentation
+        if stats is None:
+            tokens = _token_pattern.findall(string)
+        else:
+            # the phase _scan records, the parser reads the tokens without it
+            start = time.perf_counter()
+            tokens = _token_pattern.findall(string)
+            stats.record('scan', time.perf_counter() - start)
+        tokens.append(('', '', '', '', '', '', '', ''))
+        operands = []
+        # (binding power an operator needs to join the right operand, node class, token index);
+        # the node class is None for a parenthesis and _negate for unary minus
+        waiting = []
+        # local names are faster to look up in the loop below
+        binary_operators = _binary_operators
+        if _interned is None:
+            constant = _new_constant
+            variable = _new_variable
+            binary = _new_binary
+        else:
+            constant = Constant
+            variable = Variable
+            binary = _construct
+        negate = _negate
+        unary_bp = _unary_bp
+        k = 0
+        while True:
+            # an operand, possibly after unary minuses and opening parentheses
+            op, ident, flt, integer, lparen, rparen, comma, error = tokens[k]
+            if ident:
+                operands.append(variable(ident))
+            elif integer:
+                try:
+                    value = int(integer)
+                except ValueError:
+                    # more digits than int() converts, see sys.set_int_max_str_digits
+                    raise ParseError('Integer of %d digits is too long' % len(integer),
+                                     _token_position(string, k)) from None
+                operands.append(constant(value))
+            elif flt:
+                operands.append(constant(float(flt)))
+            elif lparen:
+                waiting.append((0, None, k))
+                k += 1
+                continue
+            elif op == '-':
+                # unary minus binds less tightly than **, so -2 ** 2 == -(2 ** 2)
+                waiting.append((unary_bp, negate, k))
+                k += 1
+                continue
+            elif error:
+                raise ParseError('Unexpected character %r' % error, _token_position(string, k))
+            elif op or rparen or comma:
+                raise ParseError('Unexpected token %r' % (op or rparen or comma), _token_position(string, k))
+            else:
+                raise ParseError('Unexpected end of expression', _token_position(string, k))
+            k += 1
+            # the operators and closing parentheses following it
+            while True:
+                op, ident, flt, integer, lparen, rparen, comma, error = tokens[k]
+                if op:
+                    bp, right, node = binary_operators[op]
+                else:
+                    # nothing binds as loosely as a closing parenthesis or the end
+                    bp = 0
+                while waiting and bp < waiting[-1][0]:
+                    node_bp, apply, index = waiting.pop()
+                    if apply is negate:
+                        operands[-1] = negate(operands[-1])
+                    else:
+                        rhs = operands.pop()
+                        operands[-1] = binary(apply, operands[-1], rhs)
+                if op:
+                    # a left-associative operator only takes operators binding tighter into its right operand
+                    waiting.append((bp if right else bp + 1, node, k))
+                    k += 1
+                    break
+                if rparen:
+                    if not waiting:
+                        raise ParseError('Unmatched closing parenthesis', _token_position(string, k))
+                    waiting.pop()
+                    k += 1
+                    continue
+                if waiting:
+                    raise ParseError('Unclosed parenthesis', _token_position(string, waiting[-1][2]))
+                if error:
+                    raise ParseError('Unexpected character %r' % error, _token_position(string, k))
+                if ident or flt or integer or lparen or comma:
+                    raise ParseError('Unexpected token %r' % (ident or flt or integer or lparen or comma),
+                                     _token_position(string, k))
+                return operands[0]
+
+
+def _construct(cls, lhs, rhs):
+    return cls(lhs, rhs)
+
+
+# the operand of unary minus, negated: negative constants stay constants
+def _negate(operand):
+    if isinstance(operand, Constant):
+        return Constant(-operand.value)
+    return MulNode(Constant(-1), operand)
+
+
+# the position in string of the token with index k, to report parse errors
+def _token_position(string, k):
+    tokens = _scan(string)
+    return tokens[k][2] if k < len(tokens) else len(string)
 
 
 class Constant(Expression):
     """Represents a constant value"""
+    __slots__ = ('value',)
+
     def __init__(self, value):
-        self.value = value
+        if _interned is not None and hasattr(self, '_hash'):
+            # an interned node which already exists, and must not change
+            return
+        object.__setattr__(self, 'value', value)
+        # in CPython hash(-1) == hash(-2), the flag keeps them apart so that
+        # the hash is a reliable fingerprint of the subtree (see compare)
+        object.__setattr__(self, '_hash', hash((Constant, value, value == -1)))
         
     def __eq__(self, other):
         if isinstance(other, Constant):
             return self.value == other.value
         else:
             return False
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return (Constant, (self.value,))
+
+    def _copy(self):
+        return Constant(self.value)
         
     def __str__(self):
         return str(self.value)
@@ -207,14 +1687,29 @@ class Constant(Expression):
 
 class Variable(Expression):
     """Represents a variable"""
+    __slots__ = ('variable',)
+
     def __init__(self, variable):
-        self.variable = variable
+        if _interned is not None and hasattr(self, '_hash'):
+            # an interned node which already exists, and must not change
+            return
+        object.__setattr__(self, 'variable', variable)
+        object.__setattr__(self, '_hash', hash((Variable, variable)))
 
     def __eq__(self, other):
         if isinstance(other, Variable):
             return self.variable == other.variable
         else:
             return False
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return (Variable, (self.variable,))
+
+    def _copy(self):
+        return Variable(self.variable)
         
     def __str__(self):
         return str(self.variable)
@@ -225,164 +1720,1184 @@ class Variable(Expression):
         
 class BinaryNode(Expression):
     """A node in the expression tree representing a binary operator."""    
-    def __init__(self, lhs, rhs, op_symbol):
-        self.lhs = lhs
-        self.rhs = rhs
-        self.op_symbol = op_symbol
+    __slots__ = ('lhs', 'rhs')
+    # the operator is a class attribute, set by every subclass
+    op_symbol = None
+
+    def __init__(self, lhs, rhs):
+        if _interned is not None and hasattr(self, '_hash'):
+            # an interned node which already exists, and must not change
+            return
+        object.__setattr__(self, 'lhs', lhs)
+        object.__setattr__(self, 'rhs', rhs)
+        object.__setattr__(self, '_hash', hash((type(self), lhs._hash, rhs._hash)))
     
     def __eq__(self, other):
-        if type(self) != type(other):
-            return False
-        elif self.op_symbol != other.op_symbol:
-            return False
-        else:
-            return self.lhs == other.lhs and self.rhs == other.rhs
-            
-    def expteq(self,other,dic1=None, dic2=None):
-        "A function to compare the similarity of operants/constants/variables in self and other expression"
-        oplist = ['+', '-', '*', '/', '**', '%', '//']
-        charlist = ['(',')',' ','.']
-        #Creating a string from self, without changing self
-        strself = str(self) 
-        #Creating a string from other, wothout changing other
-        strother = str(other)
-        #Initiating an operant string from self
-        selfop = str()
-        #Initiating an operant string from other
-        otherop = str()
-        #Initiating a Constant string from self
-        selfc = str()
-        #Initiating a Constant string from other
-        otherc = str()
-        #Initiating a Variable string from self
-        selfv = str()
-        #Intiating a Variable string from other
-        otherv = str()
-
-        #Creating a string from self, without changing self
-        for i in str(self):
-            if i in oplist:
-                # Initiating an operant string from self
-                selfop += str(i)
-            else:
-                if isint(i) == False or isnumber(i) == False:
-                    if i not in charlist:
-                        # Initiating a Variable string from self
-                        selfv += str(i)
-                else:
-                    # Initiating a Constant string from self
-                    selfc += str(i)
-        # Creating a string from other, without changing other
-        for i in str(other):
-            # Adding of the strings from other
-            if i in oplist:
-                # Initiating an operant string from other
-                otherop += str(i)
+        # compare both trees side by side with an explicit stack of node pairs
+        stack = [(self, other)]
+        while stack:
+            a, b = stack.pop()
+            if a is b:
+                continue
+            if type(a) != type(b) or a._hash != b._hash:
+                return False
+            if isinstance(a, BinaryNode):
+                stack.append((a.rhs, b.rhs))
+                stack.append((a.lhs, b.lhs))
+            elif not a == b:
+                return False
+        return True
+
+    def __hash__(self):
+        return self._hash
+
+    # pickle the tree as a flat postfix list, so deep trees do not hit the recursion limit
+    def __reduce__(self):
+        postfix = []
+        for node in self.postorder():
+            if isinstance(node, BinaryNode):
+                postfix.append(type(node))
             else:
-                if isint(i) == False or isnumber(i) == False:
-                    if i not in charlist:
-                        # Initiating a Variable string from self
-                        otherv += str(i)
-                else:
-                    # Initiating a Constant string from other
-                    otherc += str(i)
-        if (selfop == otherop) == True:
-            print(' Operations are equal and in the same order')
-        else:
-            print(' Operations are not equal')
-        if (selfc == otherc) == True:
-            print(' Constants are equal and in the same order')
-        else:
-            print(' Constants are not equal')
-        return        
+                postfix.append(node)
+        return (_unpickle, (postfix,))
             
     def __str__(self):
-        lstring = str(self.lhs)
-        rstring = str(self.rhs)
-        oplist = ['+', '-', '*', '/', '**', '%', '//']
-        for token in lstring:
-            if token in oplist:
-                if  (int(assoc(token)) == 0 and int(prec(token) <= int(prec(self.op_symbol)))):
-                    return "%s %s %s" % (lstring, self.op_symbol, rstring)
-                elif ((int(assoc(token)) == 1 and int(prec(token))) <  int(prec(self.op_symbol))):
-                    return "(%s) %s %s" % (lstring, self.op_symbol, rstring)
-        return "%s %s %s" % (lstring, self.op_symbol, rstring)
+        # the pieces of the output are collected in a list and joined once; the stack
+        # holds nodes still to be printed and strings (operators, parentheses) to emit
+        out = []
+        stack = [self]
+        pop = stack.pop
+        while stack:
+            item = pop()
+            if type(item) is str:
+                out.append(item)
+            elif not isinstance(item, BinaryNode):
+                out.append(str(item))
+            else:
+                bp, right, spaced = _printed_operators.get(item.op_symbol) or (0, False, ' %s ' % item.op_symbol)
+                # pushed in reverse: lhs, operator, rhs
+                _push_operand(stack, item.rhs, bp, right, False)
+                stack.append(spaced)
+                _push_operand(stack, item.lhs, bp, right, True)
+        return ''.join(out)
         
+    @_timed('evaluate')
     def evaluate(self, dic=None):
-        lhsEval = self.lhs.evaluate(dic)
-        rhsEval = self.rhs.evaluate(dic)
-        return eval("(%s %s %s)" % (lhsEval, self.op_symbol, rhsEval)) 
-
-    def findRoot(self , x, a = -1000, b = 1000, epsilon = 0.01):
-        "Represents a function to find zero points of an expression with 1 Variable()"
-        m = ( a + b ) / 2
-        while (b - a) > epsilon:
-            if eval(str(self), {x: m}) == 0:
-                return m
-            elif (eval(str(self), {x: a}) * eval(str(self), {x:m})) < abs(epsilon):
-                b = m
-            elif (eval(str(self), {x: b}) * eval(str(self), {x:m})) < abs(epsilon):
-                a = m
+        if _instrumentation is not None:
+            _instrumentation.update(collections.Counter('evaluate ' + type(node).__name__ for node in self.postorder()))
+        # values of the operands are kept on a stack while walking the tree in postorder
+        values = []
+        for node in self.postorder():
+            if isinstance(node, BinaryNode):
+                rhs = values.pop()
+                values[-1] = operators[node.op_symbol](values[-1], rhs)
             else:
-                b = m
-            m = ( a + b ) / 2
-        return ("{:.3f}".format(m))
+                values.append(node.evaluate(dic))
+        return values[0]
+
+    @_timed('findRoot')
+    def findRoot(self, x, a = -1000, b = 1000, epsilon = 0.01, method = 'auto', tol = 1e-12, maxiter = 100):
+        """Represents a function to find a zero point of an expression with 1 Variable(), returns a RootResult
+
+        The method 'auto' solves polynomials directly (returning the smallest root between
+        a and b) and uses 'brent' for everything else.
+        """
+        if method not in ('auto', 'polynomial', 'brent', 'newton', 'bisect'):
+            raise ValueError('Unknown method: %s' % method)
+        function = self._univariate(x)
+        if method in ('auto', 'polynomial'):
+            coefficients = self.polynomial(x)
+            roots = None
+            if coefficients is not None and len(coefficients) > 1:
+                try:
+                    roots = polynomial_roots(coefficients, a, b)
+                except OverflowError:
+                    # roots or bounds beyond the range of floats, left to brent
+                    if method == 'polynomial':
+                        raise
+            if roots is not None:
+                if len(roots) == 0:
+                    raise ValueError('No root of %s between %s and %s' % (self, a, b))
+                return RootResult(roots[0], function(roots[0]), 0, 1, True, 'polynomial')
+            if method == 'polynomial':
+                raise ValueError('%s is not a polynomial of degree 1 or more in %s' % (self, x))
+            method = 'brent'
+        evaluations = [0]
+        def f(value):
+            evaluations[0] += 1
+            return function(value)
+        if a > b:
+            a, b = b, a
+        fa = f(a)
+        fb = f(b)
+        if not fa * fb <= 0:
+            # no sign change between a and b: search for a root with the isolation engine
+            roots = isolate_roots(f, a, b, epsilon, enclosure=self._enclosure(x))
+            if len(roots) == 0:
+                raise ValueError('No root of %s between %s and %s' % (self, a, b))
+            return RootResult(roots[0], function(roots[0]), 0, evaluations[0], True, 'isolate')
+        if method == 'brent':
+            root, froot, iterations = brent(f, a, b, fa, fb, tol, maxiter)
+        elif method == 'newton':
+            try:
+                # use the exact derivative if the expression can be differentiated
+                derivative = self.diff(x)._univariate(x)
+                def df(value):
+                    evaluations[0] += 1
+                    return derivative(value)
+            except ValueError:
+                df = difference(f)
+            root, froot, iterations = newton(f, df, a, b, fa, fb, tol, maxiter)
+        else:
+            root, froot, iterations = bisect(f, a, b, fa, fb, tol, maxiter)
+        if _instrumentation is not None:
+            _instrumentation.count('root iterations', iterations)
+        # a pole or a jump in [a, b] also has a sign change, but no small function
+        # value; the same test as in isolate_roots tells them apart from a root
+        converged = iterations < maxiter and abs(froot) <= 1e-3 * max(abs(fa), abs(fb))
+        return RootResult(root, froot, iterations, evaluations[0], converged, method)
     
-    def findAllRoots(self, x, a = -1000, b = 1000, epsilon = 0.01):
-        zero = []
-        #self=str(self)
-        while abs(b - a) > epsilon:
-            if (eval(str(self), {x:a}) * eval(str(self), {x: a + epsilon})) > 0:
-                a += epsilon
-            else:
-                zero.append(self.findRoot(x, a, (a+epsilon), epsilon))
-                a += epsilon
-        return zero   
+    @_timed('findAllRoots')
+    def findAllRoots(self, x, a = -1000, b = 1000, epsilon = 0.01, workers = None, chunks = 64):
+        """Find all zero points of an expression with 1 Variable() between a and b, as a sorted list of floats
+
+        With workers, [a, b] is split into chunks equal parts, which are searched
+        in a pool of that many processes. The parts do not depend on workers, so
+        neither does the result. Polynomials are solved directly instead.
+        """
+        function = self._univariate(x)
+        coefficients = self.polynomial(x)
+        if coefficients is not None and len(coefficients) > 1:
+            try:
+                return unique_roots(polynomial_roots(coefficients, a, b), epsilon)
+            except OverflowError:
+                # roots or bounds beyond the range of floats, left to the numeric engine
+                pass
+        if workers is None:
+            return isolate_roots(function, a, b, epsilon, enclosure=self._enclosure(x))
+        if a > b:
+            a, b = b, a
+        bounds = [a + (b - a) * i / chunks for i in range(chunks)] + [b]
+        pieces = (bounds[:-1], bounds[1:])
+        if workers <= 1:
+            found = map(_chunk_roots, itertools.repeat(self), itertools.repeat(x), *pieces, itertools.repeat(epsilon))
+            return unique_roots(itertools.chain.from_iterable(found), epsilon)
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            found = pool.map(_chunk_roots, itertools.repeat(self, chunks), itertools.repeat(x, chunks), *pieces,
+                             itertools.repeat(epsilon, chunks), chunksize=max(1, chunks // (4 * workers)))
+            # roots on the boundary of two parts are found in both
+            return unique_roots(itertools.chain.from_iterable(found), epsilon)
 
         
+# the roots of expr between a and b, one part of findAllRoots run by a worker process
+def _chunk_roots(expr, x, a, b, epsilon):
+    return isolate_roots(expr._univariate(x), a, b, epsilon, enclosure=expr._enclosure(x))
+
+
+# push an operand of an operator with binding power bp onto the printer's stack,
+# surrounded by parentheses only if the parser would otherwise read it differently
+def _push_operand(stack, operand, bp, right, left_side):
+    if isinstance(operand, BinaryNode):
+        operand_bp = (_printed_operators.get(operand.op_symbol) or (0,))[0]
+        # operators of equal strength need parentheses on the side they do not associate to
+        parens = operand_bp < bp or operand_bp == bp and left_side == right
+    else:
+        # -2 ** x means -(2 ** x), so a negative base needs parentheses
+        parens = left_side and right and isinstance(operand, Constant) and str(operand).startswith('-')
+    if parens:
+        stack.append(')')
+        stack.append(operand)
+        stack.append('(')
+    else:
+        stack.append(operand)
+
+
+# rebuild a tree pickled by BinaryNode.__reduce__
+def _unpickle(postfix):
+    stack = []
+    for item in postfix:
+        if isinstance(item, type):
+            rhs = stack.pop()
+            stack[-1] = item(stack[-1], rhs)
+        else:
+            stack.append(item)
+    return stack[0]
+
+
 class AddNode(BinaryNode):
     """Represents the addition operator"""
-    def __init__(self, lhs, rhs):
-        super(AddNode, self).__init__(lhs, rhs, '+')
+    __slots__ = ()
+    op_symbol = '+'
 
 
 class SubNode(BinaryNode):
     """Represents the substraction operator"""
-    def __init__(self, lhs, rhs):
-        super(SubNode, self).__init__(lhs, rhs, '-')
+    __slots__ = ()
+    op_symbol = '-'
 
 
 class MulNode(BinaryNode):
     """Represents the multiplication operator"""
-    def __init__(self, lhs, rhs):
-        super(MulNode, self).__init__(lhs, rhs, '*')
+    __slots__ = ()
+    op_symbol = '*'
 
         
 class TrueDivNode(BinaryNode):
     """Represents the division operator"""
-    def __init__(self, lhs, rhs):
-        super(TrueDivNode, self).__init__(lhs, rhs, '/')
+    __slots__ = ()
+    op_symbol = '/'
 
 
 class PowNode(BinaryNode):
     """Represents the power operator"""
-    def __init__(self, lhs, rhs):
-        super(PowNode, self).__init__(lhs, rhs, '**')
+    __slots__ = ()
+    op_symbol = '**'
 
 
 class ModNode(BinaryNode):
     """Represents the modulus operator"""
-    def __init__(self, lhs, rhs):
-        super(ModNode, self).__init__(lhs, rhs, '%')
+    __slots__ = ()
+    op_symbol = '%'
 
 
 class FloorDivNode(BinaryNode):
     """Represents the floor division operator"""
-    def __init__(self, lhs, rhs):
-        super(FloorDivNode, self).__init__(lhs, rhs, '//')
+    __slots__ = ()
+    op_symbol = '//'
 
 
 class EqNode(BinaryNode):
     """Represents the equality operator"""
-    def __init__(self, lhs, rhs):
-        super(EqNode, self).__init__(lhs, rhs, '==')
\ No newline at end of file
+    __slots__ = ()
+    op_symbol = '=='
+
+
+# constructors used by the parser while interning is disabled: they set the slots
+# directly, skipping __new__ and __init__, which makes parsing much faster; the
+# nodes they build are the same as the ones the classes build
+_new_node = object.__new__
+_set_value = Constant.value.__set__
+_set_variable = Variable.variable.__set__
+_set_lhs = BinaryNode.lhs.__set__
+_set_rhs = BinaryNode.rhs.__set__
+_set_hash = Expression._hash.__set__
+
+
+def _new_constant(value):
+    node = _new_node(Constant)
+    _set_value(node, value)
+    _set_hash(node, hash((Constant, value, value == -1)))
+    return node
+
+
+def _new_variable(variable):
+    node = _new_node(Variable)
+    _set_variable(node, variable)
+    _set_hash(node, hash((Variable, variable)))
+    return node
+
+
+def _new_binary(cls, lhs, rhs):
+    node = _new_node(cls)
+    _set_lhs(node, lhs)
+    _set_rhs(node, rhs)
+    _set_hash(node, hash((cls, lhs._hash, rhs._hash)))
+    return node
+
+
+class Visitor():
+    """Combines an expression tree bottom-up, without recursion
+
+    Subclasses define visit_<Class>(node) for Constant and Variable, and
+    visit_<Class>(node, lhs, rhs) for operators, where lhs and rhs are the
+    results for the operands. A method for a base class (visit_BinaryNode,
+    visit_Expression) handles all subclasses without a method of their own.
+    """
+    def visit(self, expr):
+        "Return the result of visiting the whole tree"
+        return expr.fold(self._dispatch, self._dispatch)
+
+    def _dispatch(self, node, *operands):
+        for cls in type(node).__mro__:
+            method = getattr(self, 'visit_' + cls.__name__, None)
+            if method is not None:
+                return method(node, *operands)
+        raise TypeError('%s cannot visit %s' % (type(self).__name__, type(node).__name__))
+
+
+# binding power, right-associativity and node class of every binary operator
+# used by the parser; a higher binding power binds tighter (the reverse of prec())
+_binary_operators = {
+    '+': (1, False, AddNode),
+    '-': (1, False, SubNode),
+    '*': (2, False, MulNode),
+    '/': (2, False, TrueDivNode),
+    '%': (2, False, ModNode),
+    '//': (2, False, FloorDivNode),
+    '**': (3, True, PowNode),
+}
+
+# binding power, right-associativity and the operator surrounded by spaces, used by the printer
+_printed_operators = dict((op, (bp, right, ' %s ' % op)) for op, (bp, right, node) in _binary_operators.items())
+
+# binding power of the operand of unary minus
+_unary_bp = 3
+
+
+# the node classes a FlatExpression can hold, the opcode of a node is its index here
+_flat_nodes = (Constant, Variable, AddNode, SubNode, MulNode, TrueDivNode, PowNode, ModNode, FloorDivNode, EqNode)
+_flat_opcodes = dict((cls, opcode) for opcode, cls in enumerate(_flat_nodes))
+
+
+# the binary format written by FlatExpression.dumps, all numbers little-endian:
+#  - a header: magic, version, the number of nodes, constants and variables, and the
+#    width in bytes (1, 2 or 4) of the operand references
+#  - the constant pool, every constant a type tag and its value: 'i' a 64-bit int,
+#    'I' a longer int (its length and two's complement bytes), 'f' a double, 'c' a complex
+#  - the variable table, every name its length and UTF-8 bytes; a length of 255 or
+#    more is written as 255 followed by the length in 4 bytes
+#  - the opcodes of all nodes in postfix order, one byte each
+#  - a reference of width bytes for every node: for an operator the distance back to its
+#    left operand, for a Constant or Variable its index in the pool or table
+#  - a reference of width bytes for every operator: the distance back to its right operand
+_dumps_magic = b'EOX'
+_dumps_version = 1
+_dumps_header = struct.Struct('<3sBIIIB')
+_dumps_typecodes = {1: 'B', 2: 'H', 4: 'I'}
+_int64 = struct.Struct('<q')
+_uint32 = struct.Struct('<I')
+_double = struct.Struct('<d')
+_complex = struct.Struct('<dd')
+
+
+# the size bytes of data from pos on, for FlatExpression.loads
+def _take(data, pos, size):
+    if pos + size > len(data):
+        raise ValueError('Truncated serialized expression')
+    return data[pos:pos + size]
+
+
+# an array with the given typecode holding the little-endian items in data
+def _little_endian_array(typecode, data):
+    ans = array.array(typecode)
+    ans.frombytes(data)
+    if sys.byteorder == 'big':
+        ans.byteswap()
+    return ans
+
+
+class FlatExpression():
+    """An expression tree stored as parallel arrays instead of node objects
+
+    Node i has opcode opcodes[i] (an index in _flat_nodes). For an operator,
+    left[i] and right[i] are the indices of its operands, which always come
+    before i; for a Constant or Variable, left[i] is its index in constants
+    or variables. The last node is the root. Equal subtrees are stored once.
+    """
+    __slots__ = ('opcodes', 'left', 'right', 'constants', 'variables')
+
+    def __init__(self, opcodes, left, right, constants, variables):
+        self.opcodes = array.array('B', opcodes)
+        self.left = array.array('i', left)
+        self.right = array.array('i', right)
+        self.constants = list(constants)
+        self.variables = list(variables)
+
+    @staticmethod
+    def from_expression(expr):
+        "Store an expression tree as a FlatExpression"
+        opcodes = array.array('B')
+        left = array.array('i')
+        right = array.array('i')
+        constants = []
+        variables = []
+        # index of every stored node, keyed by its opcode and operands; constants are
+        # keyed like in the interning table, so Constant(2), Constant(2.0) and
+        # Constant(-0.0) each get their own entry
+        index = {}
+        pools = {}
+        def add(key, opcode, lhs, rhs):
+            i = index.get(key)
+            if i is None:
+                i = index[key] = len(opcodes)
+                opcodes.append(opcode)
+                left.append(lhs)
+                right.append(rhs)
+            return i
+        def leaf(node):
+            opcode = _flat_opcodes.get(type(node))
+            if opcode is None:
+                raise TypeError('Cannot flatten %s' % type(node).__name__)
+            if opcode == 0:
+                key, pool, value = _interning_key(Constant, (node.value,)), constants, node.value
+            else:
+                key, pool, value = (1, node.variable), variables, node.variable
+            if key not in pools:
+                pools[key] = len(pool)
+                pool.append(value)
+            return add(key, opcode, pools[key], 0)
+        def binary(node, lhs, rhs):
+            opcode = _flat_opcodes.get(type(node))
+            if opcode is None:
+                raise TypeError('Cannot flatten %s' % type(node).__name__)
+            return add((opcode, lhs, rhs), opcode, lhs, rhs)
+        expr.fold(leaf, binary)
+        return FlatExpression(opcodes, left, right, constants, variables)
+
+    def dumps(self):
+        "Encode the expression in the compact binary format read by loads"
+        out = []
+        for value in self.constants:
+            if type(value) is int:
+                if -2 ** 63 <= value < 2 ** 63:
+                    out.append(b'i' + _int64.pack(value))
+                else:
+                    data = value.to_bytes(value.bit_length() // 8 + 1, 'little', signed=True)
+                    out.append(b'I' + _uint32.pack(len(data)) + data)
+            elif type(value) is float:
+                out.append(b'f' + _double.pack(value))
+            elif type(value) is complex:
+                out.append(b'c' + _complex.pack(value.real, value.imag))
+            else:
+                raise TypeError('Cannot serialize a constant of type %s' % type(value).__name__)
+        for name in self.variables:
+            data = name.encode('utf-8')
+            if len(data) < 255:
+                out.append(bytes((len(data),)) + data)
+            else:
+                out.append(b'\xff' + _uint32.pack(len(data)) + data)
+        # operands are stored as the distance back from their operator, which is
+        # usually small, so the references fit in fewer bytes
+        opcodes = self.opcodes
+        left = [i - lhs if opcode > 1 else lhs for i, (opcode, lhs) in enumerate(zip(opcodes, self.left))]
+        right = [i - rhs for i, (opcode, rhs) in enumerate(zip(opcodes, self.right)) if opcode > 1]
+        largest = max(left + right)
+        width = 1 if largest < 1 << 8 else 2 if largest < 1 << 16 else 4
+        references = [array.array(_dumps_typecodes[width], left), array.array(_dumps_typecodes[width], right)]
+        if sys.byteorder == 'big':
+            for reference in references:
+                reference.byteswap()
+        header = _dumps_header.pack(_dumps_magic, _dumps_version, len(opcodes), len(self.constants), len(self.variables), width)
+        return b''.join([header] + out + [opcodes.tobytes()] + [reference.tobytes() for reference in references])
+
+    @staticmethod
+    def loads(data):
+        "Decode an expression written by dumps, data can be any bytes-like object"
+        data = memoryview(data)
+        try:
+            magic, version, nodes, constants, variables, width = _dumps_header.unpack_from(data)
+        except struct.error:
+            raise ValueError('Not a serialized expression') from None
+        if magic != _dumps_magic:
+            raise ValueError('Not a serialized expression')
+        if version != _dumps_version:
+            raise ValueError('Unsupported version %d of the serialized expression' % version)
+        if width not in _dumps_typecodes or nodes == 0:
+            raise ValueError('Invalid serialized expression')
+        pos = _dumps_header.size
+        pool = []
+        for _ in range(constants):
+            tag = _take(data, pos, 1)[0]
+            pos += 1
+            if tag == ord('i'):
+                pool.append(_int64.unpack(_take(data, pos, _int64.size))[0])
+                pos += _int64.size
+            elif tag == ord('f'):
+                pool.append(_double.unpack(_take(data, pos, _double.size))[0])
+                pos += _double.size
+            elif tag == ord('I'):
+                length = _uint32.unpack(_take(data, pos, _uint32.size))[0]
+                pos += _uint32.size
+                pool.append(int.from_bytes(_take(data, pos, length), 'little', signed=True))
+                pos += length
+            elif tag == ord('c'):
+                pool.append(complex(*_complex.unpack(_take(data, pos, _complex.size))))
+                pos += _complex.size
+            else:
+                raise ValueError('Unknown constant type %r in the serialized expression' % chr(tag))
+        table = []
+        for _ in range(variables):
+            length = _take(data, pos, 1)[0]
+            pos += 1
+            if length == 255:
+                length = _uint32.unpack(_take(data, pos, _uint32.size))[0]
+                pos += _uint32.size
+            table.append(str(_take(data, pos, length), 'utf-8'))
+            pos += length
+        opcodes = _little_endian_array('B', _take(data, pos, nodes))
+        pos += nodes
+        typecode = _dumps_typecodes[width]
+        left = _little_endian_array(typecode, _take(data, pos, nodes * width))
+        pos += nodes * width
+        operators = sum(1 for opcode in opcodes if opcode > 1)
+        right = iter(_little_endian_array(typecode, _take(data, pos, operators * width)))
+        # back from distances to indices
+        left = [i - lhs if opcode > 1 else lhs for i, (opcode, lhs) in enumerate(zip(opcodes, left))]
+        right = [i - next(right) if opcode > 1 else 0 for i, opcode in enumerate(opcodes)]
+        # every opcode has to be known, and every reference has to point to an earlier
+        # node, or into the pool or table
+        sizes = (len(pool), len(table))
+        for i, (opcode, lhs, rhs) in enumerate(zip(opcodes, left, right)):
+            if opcode >= len(_flat_nodes) or not (0 <= lhs < i and 0 <= rhs < i if opcode > 1 else opcode <= 1 and lhs < sizes[opcode]):
+                raise ValueError('Invalid serialized expression')
+        return FlatExpression(opcodes, left, right, pool, table)
+
+    def to_expression(self):
+        "Rebuild the expression tree, equal subtrees become shared nodes"
+        nodes = []
+        for opcode, lhs, rhs in zip(self.opcodes, self.left, self.right):
+            if opcode == 0:
+                nodes.append(Constant(self.constants[lhs]))
+            elif opcode == 1:
+                nodes.append(Variable(self.variables[lhs]))
+            else:
+                nodes.append(_flat_nodes[opcode](nodes[lhs], nodes[rhs]))
+        return nodes[-1]
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __str__(self):
+        # the same printer as BinaryNode.__str__, on node indices instead of nodes
+        out = []
+        stack = [len(self.opcodes) - 1]
+        pop = stack.pop
+        while stack:
+            item = pop()
+            if type(item) is str:
+                out.append(item)
+                continue
+            opcode = self.opcodes[item]
+            if opcode == 0:
+                out.append(str(self.constants[self.left[item]]))
+            elif opcode == 1:
+                out.append(str(self.variables[self.left[item]]))
+            else:
+                bp, right, spaced = _printed_operators.get(_flat_nodes[opcode].op_symbol) or (0, False, ' %s ' % _flat_nodes[opcode].op_symbol)
+                self._push_operand(stack, self.right[item], bp, right, False)
+                stack.append(spaced)
+                self._push_operand(stack, self.left[item], bp, right, True)
+        return ''.join(out)
+
+    def _push_operand(self, stack, operand, bp, right, left_side):
+        # see _push_operand for the rules
+        opcode = self.opcodes[operand]
+        if opcode > 1:
+            operand_bp = (_printed_operators.get(_flat_nodes[opcode].op_symbol) or (0,))[0]
+            parens = operand_bp < bp or operand_bp == bp and left_side == right
+        else:
+            parens = left_side and right and opcode == 0 and str(self.constants[self.left[operand]]).startswith('-')
+        if parens:
+            stack.append(')')
+            stack.append(operand)
+            stack.append('(')
+        else:
+            stack.append(operand)
+
+    def evaluate(self, dic=None):
+        "Evaluate the expression, like Expression.evaluate"
+        functions = [operators[cls.op_symbol] if opcode > 1 else None for opcode, cls in enumerate(_flat_nodes)]
+        constants = self.constants
+        values = []
+        append = values.append
+        for opcode, lhs, rhs in zip(self.opcodes, self.left, self.right):
+            if opcode == 0:
+                append(float(constants[lhs]))
+            elif opcode == 1:
+                append(dic[self.variables[lhs]])
+            else:
+                append(functions[opcode](values[lhs], values[rhs]))
+        return values[-1]
+
+
+class IncrementalEvaluator():
+    """Evaluates an expression again and again while only some of its variables change
+
+    The value of every node is kept. update recomputes only the nodes above the
+    variables which changed, in postorder, so each one after its operands;
+    subtrees without variables are computed once.
+    """
+    def __init__(self, expr, dic):
+        names = expr.variables()
+        missing = names - set(dic)
+        if missing:
+            raise ValueError('Missing values for variables: %s' % ', '.join(sorted(missing)))
+        # the nodes in postorder, a subtree which occurs more than once is stored once
+        index = {}
+        self._functions = []
+        self._operands = []
+        self._parents = []
+        # the indices of the Variable nodes of every variable
+        self._variables = dict((name, []) for name in names)
+        self._values = []
+        for node in expr.postorder():
+            if id(node) in index:
+                continue
+            i = index[id(node)] = len(self._values)
+            self._parents.append([])
+            if isinstance(node, BinaryNode):
+                lhs, rhs = index[id(node.lhs)], index[id(node.rhs)]
+                function = operators[node.op_symbol]
+                self._functions.append(function)
+                self._operands.append((lhs, rhs))
+                self._parents[lhs].append(i)
+                if rhs != lhs:
+                    self._parents[rhs].append(i)
+                self._values.append(function(self._values[lhs], self._values[rhs]))
+            else:
+                if isinstance(node, Variable):
+                    self._variables[node.variable].append(i)
+                self._functions.append(None)
+                self._operands.append(None)
+                self._values.append(node.evaluate(dic))
+        # nodes which still have to be recomputed, if an update raised an exception
+        self._dirty = set()
+
+    @property
+    def value(self):
+        "The value of the expression"
+        return self._values[-1]
+
+    def update(self, dic):
+        "Change the values of some variables, return the new value of the expression; other variables are ignored, like in evaluate"
+        values = self._values
+        parents = self._parents
+        dirty = self._dirty
+        stack = []
+        for name, value in dic.items():
+            for i in self._variables.get(name, ()):
+                values[i] = value
+                stack.append(i)
+        # mark everything above the changed variables; a node which is marked
+        # already has its ancestors marked as well
+        while stack:
+            for parent in parents[stack.pop()]:
+                if parent not in dirty:
+                    dirty.add(parent)
+                    stack.append(parent)
+        functions = self._functions
+        operands = self._operands
+        for i in sorted(dirty):
+            lhs, rhs = operands[i]
+            values[i] = functions[i](values[lhs], values[rhs])
+        dirty.clear()
+        return values[-1]
+
+
+# a line parsed by parse_many: its line number, and the expression or the ParseError
+ParsedLine = collections.namedtuple('ParsedLine', ['lineno', 'expression', 'error'])
+
+
+# parse a chunk of (lineno, string) pairs; from a worker process the trees are sent
+# back as FlatExpressions, which pickle as a few arrays instead of a node per object
+def _parse_chunk(chunk, flat=True):
+    ans = []
+    for lineno, string in chunk:
+        try:
+            expr = Expression.parseString(string)
+            ans.append((lineno, expr.flatten() if flat else expr, None))
+        except (ValueError, OverflowError) as error:
+            # a ParseError, or any other error on the line, is reported with the line
+            # and does not stop the batch
+            ans.append((lineno, None, error))
+    return ans
+
+
+def _parse_numbered(numbered, workers, chunksize, flat):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    numbered = iter(numbered)
+    chunks = iter(lambda: list(itertools.islice(numbered, chunksize)), [])
+    def results(chunk):
+        for lineno, expression, error in chunk:
+            if not flat and isinstance(expression, FlatExpression):
+                expression = expression.to_expression()
+            yield ParsedLine(lineno, expression, error)
+    if workers <= 1:
+        for chunk in chunks:
+            yield from results(_parse_chunk(chunk, flat))
+        return
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        # keep a couple of chunks per worker in flight, so the input is read as it is
+        # needed and the results come out in input order
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_parse_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield from results(pending.popleft().result())
+        while pending:
+            yield from results(pending.popleft().result())
+
+
+def parse_many(strings, workers=None, chunksize=1000, flat=False):
+    """Parse many strings in a pool of worker processes, yield a ParsedLine per string
+
+    The results come in input order, numbered from 1. A string which does not
+    parse gives a ParsedLine with expression None and the ParseError, the other
+    strings are parsed as usual. The expressions are Expressions, or
+    FlatExpressions if flat is true, which saves converting them back.
+    workers defaults to the number of CPUs, with 1 everything is parsed in
+    this process.
+    """
+    return _parse_numbered(enumerate(strings, 1), workers, chunksize, flat)
+
+
+def parse_file(path, workers=None, chunksize=1000, flat=False, encoding='utf-8'):
+    "Parse a file with one expression per line like parse_many, streaming the file; blank lines are skipped"
+    with open(path, encoding=encoding) as lines:
+        numbered = ((lineno, line) for lineno, line in enumerate(lines, 1) if line.strip())
+        yield from _parse_numbered(numbered, workers, chunksize, flat)
+
+
+# a file of serialized expressions: a header (magic and version), the expressions one
+# after the other as written by dumps, the end offset of every expression, and a footer
+# with the number of expressions, the offset of that index and the magic again
+_file_magic = b'EOXF'
+_file_header = struct.Struct('<4sB')
+_file_footer = struct.Struct('<QQ4s')
+
+
+def dump_file(path, expressions):
+    "Write expressions (or FlatExpressions) to a file which ExpressionFile can read, return how many were written"
+    ends = array.array('Q')
+    with open(path, 'wb') as out:
+        out.write(_file_header.pack(_file_magic, _dumps_version))
+        offset = _file_header.size
+        for expr in expressions:
+            data = expr.dumps()
+            out.write(data)
+            offset += len(data)
+            ends.append(offset)
+        if sys.byteorder == 'big':
+            ends.byteswap()
+        out.write(ends.tobytes())
+        out.write(_file_footer.pack(len(ends), offset, _file_magic))
+    return len(ends)
+
+
+class ExpressionFile():
+    """A file written by dump_file, memory-mapped so that an expression can be loaded by index
+
+    Only the bytes of the expressions which are loaded are read from the file.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as source:
+            # every file has a header and a footer, and mmap cannot map an empty file
+            if os.fstat(source.fileno()).st_size < _file_header.size + _file_footer.size:
+                raise ValueError('Not an expression file: %s' % path)
+            self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version = _file_header.unpack_from(self._map)
+            count, index, footer = _file_footer.unpack_from(self._map, len(self._map) - _file_footer.size)
+            if magic != _file_magic or footer != _file_magic:
+                raise ValueError('Not an expression file: %s' % path)
+            if version != _dumps_version:
+                raise ValueError('Unsupported version %d of expression file %s' % (version, path))
+            # the ends of the expressions are stored between the last one and the footer
+            if index < _file_header.size or index + 8 * count != len(self._map) - _file_footer.size:
+                raise ValueError('Damaged expression file: %s' % path)
+            self._index = index
+            self._ends = array.array('Q')
+            self._ends.frombytes(self._map[index:index + 8 * count])
+            if sys.byteorder == 'big':
+                self._ends.byteswap()
+        except (struct.error, ValueError):
+            self._map.close()
+            raise
+
+    def __len__(self):
+        return len(self._ends)
+
+    def _view(self, i, load):
+        if i < 0:
+            i += len(self._ends)
+        if not 0 <= i < len(self._ends):
+            raise IndexError('expression index out of range')
+        start = self._ends[i - 1] if i > 0 else _file_header.size
+        if not start < self._ends[i] <= self._index:
+            raise ValueError('Damaged expression file')
+        with memoryview(self._map) as view:
+            return load(view[start:self._ends[i]])
+
+    def __getitem__(self, i):
+        return self._view(i, Expression.loads)
+
+    def flat(self, i):
+        "Load expression i as a FlatExpression"
+        return self._view(i, FlatExpression.loads)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# evaluate expr for a batch of rows, columns maps every variable of expr to a list of
+# size floats; returns the float value, or the exception evaluate raises, per row
+def _evaluate_columns(expr, columns, size):
+    function = expr.compile()
+    values = None
+    if np is not None and size > 1 and function.variables:
+        values = expr.evaluate_batch(dict((name, np.asarray(columns[name], dtype=float))
+                                          for name in function.variables)).tolist()
+    ans = []
+    for k in range(size):
+        value = math.nan if values is None else values[k]
+        if not math.isfinite(value):
+            # the batch has inf or nan where evaluate raises or has a complex value,
+            # those rows are evaluated again to report the same as evaluate
+            try:
+                value = function(*[columns[name][k] for name in function.variables])
+            except (ArithmeticError, ValueError, TypeError) as error:
+                ans.append(error)
+                continue
+            if isinstance(value, complex):
+                ans.append(ValueError('Complex result: %s' % value))
+                continue
+        ans.append(float(value))
+    return ans
+
+
+# evaluate several expressions for a batch of rows, columns maps variable names to lists
+# of size raw values (strings or numbers, None where the value is missing); returns a list
+# per expression with the float value, or an exception, per row
+def _evaluate_chunk(expressions, columns, size):
+    floats = {}
+    invalid = {}
+    for name, values in columns.items():
+        converted = floats[name] = []
+        for k, value in enumerate(values):
+            try:
+                converted.append(float(value))
+            except (TypeError, ValueError):
+                converted.append(math.nan)
+                if value is None:
+                    invalid.setdefault(name, {})[k] = ValueError('Missing variable %s' % name)
+                else:
+                    invalid.setdefault(name, {})[k] = ValueError('Bad value for %s: %r' % (name, value))
+    ans = []
+    for expr in expressions:
+        values = _evaluate_columns(expr, floats, size)
+        for name in expr.compile().variables:
+            for k, error in invalid.get(name, {}).items():
+                values[k] = error
+        ans.append(values)
+    return ans
+
+
+# the rows of a CSV file as lists of cells, with the header
+def _csv_rows(source):
+    reader = csv.reader(source)
+    header = next(reader, [])
+    return header, reader
+
+
+# NaN and Infinity are accepted by json.loads, but are no JSON
+def _reject_constant(name):
+    raise ValueError('%s is not valid JSON' % name)
+
+
+# the rows of a JSON-lines file as dictionaries, None for a line which is no JSON object
+def _jsonl_rows(source):
+    for line in source:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line, parse_constant=_reject_constant)
+        except ValueError:
+            row = None
+        yield row if isinstance(row, dict) else None
+
+
+def _eval_command(args):
+    names = []
+    expressions = []
+    for formula in args.formulas:
+        # NAME=EXPRESSION names the output column, which is the expression itself otherwise
+        match = re.match(r'\s*([A-Za-z_]\w*)\s*=(?!=)(.*)$', formula)
+        name, string = match.groups() if match else (formula, formula)
+        try:
+            expressions.append(Expression.fromString(string))
+        except ParseError as error:
+            print('Cannot parse %s: %s' % (string, error), file=sys.stderr)
+            return 2
+        names.append(name)
+    needed = sorted(set().union(*[expr.variables() for expr in expressions]))
+    form = args.format or ('jsonl' if args.input.endswith(('.jsonl', '.ndjson', '.json')) else 'csv')
+    with contextlib.ExitStack() as stack:
+        if args.input == '-':
+            source = sys.stdin
+        else:
+            source = stack.enter_context(open(args.input, newline='', encoding='utf-8'))
+        if args.output == '-':
+            target = sys.stdout
+        else:
+            target = stack.enter_context(open(args.output, 'w', newline='', encoding='utf-8'))
+        if form == 'csv':
+            header, rows = _csv_rows(source)
+            missing = [name for name in needed if name not in header]
+            if missing:
+                print('No column for %s in %s' % (', '.join(missing), args.input), file=sys.stderr)
+                return 2
+            # variables are read by column index, the first column of a name counts
+            position = dict((name, header.index(name)) for name in needed)
+            width = len(header)
+            writer = csv.writer(target)
+            writer.writerow(names if args.results_only else header + names)
+        else:
+            rows = _jsonl_rows(source)
+        start = time.perf_counter()
+        count = errors = 0
+        # the input is read, evaluated and written chunk by chunk, so memory does not grow with it
+        for chunk in iter(lambda: list(itertools.islice(rows, args.chunk_size)), []):
+            if form == 'csv':
+                # the cells missing from a short row are missing values, a row with
+                # more cells than the header does not match it and fails
+                failed = [len(row) > width for row in chunk]
+                columns = dict((name, [row[i] if i < len(row) else None for row in chunk])
+                               for name, i in position.items())
+            else:
+                failed = [row is None for row in chunk]
+                columns = dict((name, [None if row is None else row.get(name) for row in chunk])
+                               for name in needed)
+            results = _evaluate_chunk(expressions, columns, len(chunk))
+            for k, row in enumerate(chunk):
+                if failed[k]:
+                    values = [ValueError('Malformed row')] * len(expressions)
+                else:
+                    values = [values[k] for values in results]
+                    # JSON has no numbers for inf and nan, in both formats they count as errors
+                    values = [value if isinstance(value, Exception) or math.isfinite(value)
+                              else ValueError('Result is %s' % value) for value in values]
+                errors += sum(isinstance(value, Exception) for value in values)
+                if form == 'csv':
+                    values = ['' if isinstance(value, Exception) else repr(value) for value in values]
+                    # every row is written as wide as the header, so the results line up
+                    cells = row[:width] + [''] * (width - len(row))
+                    writer.writerow(values if args.results_only else cells + values)
+                else:
+                    values = [None if isinstance(value, Exception) else value for value in values]
+                    out = {} if args.results_only or row is None else row
+                    out.update(zip(names, values))
+                    target.write(json.dumps(out, allow_nan=False) + '\n')
+            target.flush()
+            count += len(chunk)
+        elapsed = time.perf_counter() - start
+    print('%d rows in %.3f s, %.0f rows/s, %d errors' % (count, elapsed, count / max(elapsed, 1e-9), errors),
+          file=sys.stderr)
+    return 0
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m Eindopdracht', description='Work with mathematical expressions')
+    commands = parser.add_subparsers(dest='command', required=True)
+    evaluate = commands.add_parser('eval', help='evaluate expressions for every row of a CSV or JSON-lines file')
+    evaluate.add_argument('formulas', nargs='+', metavar='FORMULA',
+                          help='expression to evaluate, NAME=EXPRESSION names its output column')
+    evaluate.add_argument('--input', default='-', help='CSV file with a header, or JSON-lines file (default standard input)')
+    evaluate.add_argument('--output', default='-', help='file to write, in the format of the input (default standard output)')
+    evaluate.add_argument('--format', choices=('csv', 'jsonl'), help='format of the input (default from its extension, or csv)')
+    evaluate.add_argument('--chunk-size', type=int, default=10000, help='rows evaluated at once (default 10000)')
+    evaluate.add_argument('--results-only', action='store_true', help='write only the results, not the input columns')
+    args = parser.parse_args(args)
+    return _eval_command(args)
+
+
+# building blocks for new expressions, which leave out the trivial cases
+# (adding zero, multiplying by one, ...) and fold operators on two constants
+def _isconstant(expr, value):
+    return isinstance(expr, Constant) and expr.value == value
+
+
+# a op b computed on floats like evaluate does, so folding does not change the value;
+# an integral result of integers stays an int while a float holds it exactly
+def _arithmetic(op_symbol, a, b):
+    ans = operators[op_symbol](float(a), float(b))
+    if isinstance(a, int) and isinstance(b, int) and isinstance(ans, float) \
+    and ans.is_integer() and abs(ans) <= 2 ** 53:
+        return int(ans)
+    return ans
+
+
+def _fold(lhs, rhs, op_symbol):
+    try:
+        ans = _arithmetic(op_symbol, lhs.value, rhs.value)
+    except (ArithmeticError, ValueError):
+        return None
+    # complex and infinite results have no constant that str() writes parseably
+    if isinstance(ans, complex) or not math.isfinite(ans):
+        return None
+    return Constant(ans)
+
+
+def _add(lhs, rhs):
+    if _isconstant(lhs, 0):
+        return rhs
+    if _isconstant(rhs, 0):
+        return lhs
+    if isinstance(lhs, Constant) and isinstance(rhs, Constant):
+        return _fold(lhs, rhs, '+') or AddNode(lhs, rhs)
+    return AddNode(lhs, rhs)
+
+
+def _sub(lhs, rhs):
+    if _isconstant(rhs, 0):
+        return lhs
+    if isinstance(lhs, Constant) and isinstance(rhs, Constant):
+        return _fold(lhs, rhs, '-') or SubNode(lhs, rhs)
+    if _isconstant(lhs, 0):
+        return _mul(Constant(-1), rhs)
+    return SubNode(lhs, rhs)
+
+
+def _mul(lhs, rhs):
+    if _isconstant(lhs, 0) or _isconstant(rhs, 0):
+        return Constant(0)
+    if _isconstant(lhs, 1):
+        return rhs
+    if _isconstant(rhs, 1):
+        return lhs
+    if isinstance(lhs, Constant) and isinstance(rhs, Constant):
+        return _fold(lhs, rhs, '*') or MulNode(lhs, rhs)
+    return MulNode(lhs, rhs)
+
+
+def _div(lhs, rhs):
+    if _isconstant(rhs, 1):
+        return lhs
+    if _isconstant(lhs, 0) and not _isconstant(rhs, 0):
+        return Constant(0)
+    if isinstance(lhs, Constant) and isinstance(rhs, Constant):
+        return _fold(lhs, rhs, '/') or TrueDivNode(lhs, rhs)
+    return TrueDivNode(lhs, rhs)
+
+
+def _pow(lhs, rhs):
+    if _isconstant(rhs, 0):
+        return Constant(1)
+    if _isconstant(rhs, 1):
+        return lhs
+    if isinstance(lhs, Constant) and isinstance(rhs, Constant):
+        return _fold(lhs, rhs, '**') or PowNode(lhs, rhs)
+    return PowNode(lhs, rhs)
+
+
+# the builders used by simplify for every operator which has one
+_builders = {
+    AddNode: _add,
+    SubNode: _sub,
+    MulNode: _mul,
+    TrueDivNode: _div,
+    PowNode: _pow,
+}
+
+_sum_nodes = (AddNode, SubNode)
+_product_nodes = (MulNode,)
+
+
+# split a term into a numerical coefficient and the rest, which is None for a constant
+def _split_coefficient(term):
+    if isinstance(term, Constant):
+        return term.value, None
+    if isinstance(term, MulNode):
+        if isinstance(term.lhs, Constant):
+            return term.lhs.value, term.rhs
+        if isinstance(term.rhs, Constant):
+            return term.rhs.value, term.lhs
+    return 1, term
+
+
+# the sum or product of constants, or None when it is not exact: evaluation would add or
+# multiply them in another order, with x in between, so only exact results are combined
+def _combine_exactly(op_symbol, values):
+    try:
+        ans = functools.reduce(functools.partial(_arithmetic, op_symbol), values)
+        exact = functools.reduce(operators[op_symbol], map(fractions.Fraction, values))
+        return ans if fractions.Fraction(ans) == exact else None
+    except (ArithmeticError, ValueError, TypeError):
+        # infinite, nan or complex
+        return None
+
+
+# rebuild a chain of + and -, adding up the coefficients of equal terms and all constants
+def _collect_sum(expr):
+    constants = []
+    coefficients = {}
+    stack = [(expr, 1)]
+    while stack:
+        node, sign = stack.pop()
+        if isinstance(node, _sum_nodes):
+            stack.append((node.rhs, sign if isinstance(node, AddNode) else -sign))
+            stack.append((node.lhs, sign))
+            continue
+        coefficient, term = _split_coefficient(node)
+        if term is None:
+            constants.append(sign * coefficient)
+        else:
+            coefficients.setdefault(term, []).append(sign * coefficient)
+    # (coefficient, term) pairs, the term is None for a constant
+    pieces = []
+    for term, values in list(coefficients.items()) + [(None, constants)]:
+        total = _combine_exactly('+', values) if values else 0
+        if total is None:
+            pieces.extend((value, term) for value in values)
+        else:
+            pieces.append((total, term))
+    ans = None
+    for coefficient, term in pieces:
+        if coefficient == 0:
+            continue
+        if ans is None:
+            ans = Constant(coefficient) if term is None else _mul(Constant(coefficient), term)
+            continue
+        operand = Constant(abs(coefficient)) if term is None else _mul(Constant(abs(coefficient)), term)
+        ans = SubNode(ans, operand) if coefficient < 0 else AddNode(ans, operand)
+    return Constant(0) if ans is None else ans
+
+
+# rebuild a chain of *, multiplying all constants and adding up the exponents of equal factors
+def _collect_product(expr):
+    constants = []
+    exponents = {}
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, _product_nodes):
+            stack.append(node.rhs)
+            stack.append(node.lhs)
+        elif isinstance(node, Constant):
+            constants.append(node.value)
+        elif isinstance(node, PowNode) and isinstance(node.rhs, Constant):
+            exponents.setdefault(node.lhs, []).append(node.rhs.value)
+        else:
+            exponents.setdefault(node, []).append(1)
+    coefficient = _combine_exactly('*', constants) if constants else 1
+    if coefficient == 0:
+        return Constant(coefficient)
+    ans = None
+    for base, values in exponents.items():
+        total = _combine_exactly('+', values)
+        for exponent in values if total is None else [total]:
+            factor = _pow(base, Constant(exponent))
+            ans = factor if ans is None else _mul(ans, factor)
+    if coefficient is None:
+        # the constants stay apart, as they are
+        product = Constant(constants[0])
+        for value in constants[1:]:
+            product = MulNode(product, Constant(value))
+        return product if ans is None else MulNode(product, ans)
+    if ans is None:
+        return Constant(coefficient)
+    return _mul(Constant(coefficient), ans)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,6 +9,7 @@ B.J.M. van Dijk & M.O. El-Haloush @ Utrecht, 2015
 """
 
 import math
+import operator
 
 # split a string into mathematical tokens
 # returns a list of numbers, operators, parantheses and commas
@@ -94,12 +95,9 @@ class Expression():
     def __floordiv__(self, other):
         return FloorDivNode(self, other)
   
-    def __str__(self,var=None):
-        def evaluate(self, var=None):
-            ans = evaluate(self,var)
-            return ans
-        ans=replace(self,var)
-        return ans 
+    def __str__(self, var=None):
+        ans = replace(self, var)
+        return ans
 
     # basic Shunting-yard algorithm
     def fromString(string):
@@ -162,297 +160,99 @@ class Expression():
         return stack[0]
 
 
-def replace(self, var = None):
-    "A function for replacing a variable with its respective value from a dictionary"
-    self = str(self)
-    if var == None:
-        return self
-    else:
-        ans = str()
-        for i in self:
-            if i in var:
-                j = var.get(i)
-                ans += str(j)
+# precedence of the operators, used by minimum to leave out parentheses
+precedence = {'+': 1, '-': 1, '*': 2, '/': 2, '%': 2, '//': 2, '**': 3}
+
+operators = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '**': operator.pow,
+    '%': operator.mod,
+    '//': operator.floordiv,
+}
+
+
+# check if the operand of an operator needs parentheses, because it would be read
+# differently without them; without minimal every operator gets them
+def needsbrackets(operand, op_symbol, left, minimal = True):
+    if isinstance(operand, BinaryNode):
+        if not minimal:
+            return True
+        if precedence[operand.op_symbol] != precedence[op_symbol]:
+            return precedence[operand.op_symbol] < precedence[op_symbol]
+        # ** groups from the right, the other operators from the left
+        return left == (op_symbol == '**')
+    # a negative number to the left of ** does, -2 ** 2 is -(2 ** 2)
+    return left and op_symbol == '**'
+
+
+def tostring(self, var = None, minimal = False):
+    "A function which prints an Expression in one pass over the tree, with the variables in var replaced by their values"
+    pieces = []
+    # the stack holds the nodes still to be printed, with whether they need parentheses,
+    # and the operators and parentheses which go between them
+    stack = [(self, not minimal and isinstance(self, BinaryNode))]
+    while len(stack) > 0:
+        item = stack.pop()
+        if isinstance(item, str):
+            pieces.append(item)
+            continue
+        node, brackets = item
+        if isinstance(node, BinaryNode):
+            if brackets:
+                stack.append(')')
+            stack.append((node.rhs, needsbrackets(node.rhs, node.op_symbol, False, minimal)))
+            stack.append(' %s ' % node.op_symbol)
+            stack.append((node.lhs, needsbrackets(node.lhs, node.op_symbol, True, minimal)))
+            if brackets:
+                stack.append('(')
+        else:
+            if isinstance(node, Variable) and var is not None and node.variable in var:
+                value = str(var[node.variable])
             else:
-                ans += str(i)    
-        self = ans
-        return self
+                value = str(node)
+            if brackets and value.startswith('-'):
+                value = '(%s)' % value
+            pieces.append(value)
+    return ''.join(pieces)
 
-        
-def evaluate(self,var=None):
-    "A function for the evaluation of an Expression"
-    new=replace(self,var) 
-    charlist = ['+', '-', '*', '/', '**', '%', '//', '(', ')']
-    oplist = ['+','-','*','/','**', '%','//']
-    i = 0
-    def calc(string):
-        "A Function that will return a float from input, here the input is a part of the Expression tree"
-        calc = str(string)
-        i = 0
-        j = 0
-        k = 0
-        newcalc=0
-        #Finding an operation from the oplist (First while statement)
-        #Finding an character from the charlist to the left of the found operation from first while statement (second while statement)
-        #Finding of a character from the charlist to the right of the found operation from first while statement (third while statement)
-        while i < len(calc):
-            if calc[i] in oplist:
-                if calc[i] == '+':
-                    j = i - 1
-                    while j >= 0:
-                        if calc[j] in charlist:
-                            k = i + 1
-                            while k <= len(calc):
-                                if calc[k] in charlist:
-                                    newcalc += float(calc[j + 1:i]) + float(calc[i + 1:k])
-                                    calc = calc[:j] + str(newcalc) + calc[k:]
-                                    k = (len(calc) + 1)
-                                else:
-                                    k += 1
-                            j = -1
-                            i = 0
-                        else:
-                            j -= 1
-                if calc[i] == '-':
-                    j = i - 1
-                    while j >= 0:
-                        if calc[j] in charlist:
-                            k=i+1
-                            while k <= len(calc):
-                                if calc[k] in charlist:
-                                    newcalc += float(calc[j + 1:i])-float(calc[i + 1:k])
-                                    calc=calc[:j] + str(newcalc) + calc[k:]
-                                    k = (len(calc) + 1)
-                                else:
-                                    k += 1
-                            j = -1
-                            i = 0
-                        else:
-                            j -= 1
-                if calc[i] == '*' and calc[i + 1] == '*':
-                    #Found an ** operation, requires an altered code
-                    j = i - 1
-                    while j >= 0:
-                        if calc[j] in charlist:
-                            k = i + 2
-                            while k <= len(calc):
-                                if calc[k] in charlist:
-                                    newcalc += float(calc[j + 1:i]) ** float(calc[i + 2:k])
-                                    calc = calc[:j] + str(newcalc) + calc[k:]
-                                    k = (len(calc) + 1)
-                                else:
-                                    k += 1
-                            j = -1
-                            i = 0
-                        else:
-                            j -= 1
-                if calc[i] == '/' and calc[i + 1] == '/':
-                    #Found an // operation, requires an altered code 
-                    j = i - 1
-                    while j >= 0:
-                        if calc[j] in charlist:
-                            k = i + 2
-                            while k <= len(calc):
-                                if calc[k] in charlist:
-                                    newcalc += float(calc[j + 1:i]) // float(calc[i + 2:k])
-                                    calc = calc[:j] + str(newcalc) + calc[k:]
-                                    k = (len(calc) + 1)
-                                else:
-                                    k += 1
-                            j = -1
-                            i = 0
-                        else:
-                            j -= 1
-                if calc[i] == '*':
-                    j = i - 1
-                    while j >= 0:
-                        if calc[j] in charlist:
-                            k = i + 1
-                            while k <= len(calc):
-                                if calc[k] in charlist:
-                                    newcalc += float(calc[j + 1:i]) * float(calc[i + 1:k])
-                                    calc = calc[:j] + str(newcalc) + calc[k:]
-                                    k = (len(calc) + 1)
-                                else:
-                                    k += 1
-                            j = -1
-                            i = 0
-                        else:
-                            j -= 1            
-                if calc[i] == '/':
-                    j = i - 1
-                    while j >= 0:
-                        if calc[j] in charlist:
-                            k = i + 1
-                            while k <= len(calc):
-                                if calc[k] in charlist:
-                                    newcalc += float(calc[j + 1:i]) / float(calc[i + 1:k])
-                                    calc = calc[:j] + str(newcalc) + calc[k:]
-                                    k = (len(calc) + 1)
-                                else:
-                                    k += 1
-                            j = -1
-                            i = 0
-                        else:
-                            j -= 1
-                if calc[i] == '%':
-                    j = i - 1
-                    while j >= 0:
-                        if calc[j] in charlist:
-                            k = i + 1
-                            while k <= len(calc):
-                                if calc[k] in charlist:
-                                    newcalc += float(calc[j + 1:i]) % float(calc[i + 1:k])
-                                    calc = calc[:j] + str(newcalc) + calc[k:]
-                                    k = (len(calc) + 1)
-                                else:
-                                    k += 1
-                            j = -1
-                            i = 0
-                        else:
-                            j -= 1            
-                else:
-                    i += 1
-                    
-            else:
-                i += 1
-        newcalc = str()
-        remove = str()
-        #Dicarding the brackets from the string for representation
-        for i in calc:
-            if i == '(' or i == ')':
-                remove += i
-            else:
-                newcalc += i
-        calc = newcalc        
-        return calc
-    #Finding the first part of the Expression to be evaluated by the function calc()    
-    count = new.count("(") 
-    while i < len(new):
-        if new[i] == '(':
-            if count == 1:    
-                j = i + 1
-                while j < len(new):
-                    if new[j] == ')':
-                        ans = (calc(new[i:j + 1]))
-                        new = new[:i] + str(ans) + new[j + 1:]
-                        j = len(new)
-                        i = 0
-                        count = new.count("(")
-                    else:
-                        j += 1
+
+def replace(self, var = None):
+    "A function for replacing a variable with its respective value from a dictionary"
+    return tostring(self, var)
+
+
+def evaluate(self, var = None):
+    "A function for the evaluation of an Expression, in one pass over the tree"
+    values = []
+    # the stack holds the nodes still to be evaluated, with whether their operands are done
+    stack = [(self, False)]
+    while len(stack) > 0:
+        node, done = stack.pop()
+        if isinstance(node, BinaryNode):
+            if done:
+                rhs = values.pop()
+                values[-1] = operators[node.op_symbol](values[-1], rhs)
             else:
-                count -= 1
-                i += 1
+                stack.append((node, True))
+                stack.append((node.rhs, False))
+                stack.append((node.lhs, False))
+        elif isinstance(node, Variable):
+            if var is None or node.variable not in var:
+                raise ValueError('No value for variable: %s' % node.variable)
+            values.append(float(var[node.variable]))
         else:
-            i += 1
-    return new
+            values.append(float(node.value))
+    return str(values[0])
 
 
 def minimum(self):
     "A function to limit the amount of brackets in the Expresion"
-    oplist = ['+', '-', '*', '/', '**', '%', '//']
-    oplist2 = ['+','-']
-    oplist3 = ['*','/']
-    oplist4 = ['**']
-    oplist5 = ['%']
-    oplist6 = ['//']
-    new = (str(self))
-    i = 0
-    j = 0
-    #This algortihm works in a similar manner as de while statements of the function evaluate.calc(). It determines wheter brackets are needed between two operations
-    while i < len(new):
-        if new[i] in oplist:
-            if new[i] in oplist2:
-                j = i + 1
-                while j < len(new):
-                    if new[j] in oplist:
-                        if new[j] in oplist2:
-                            new1 = new[i:j]
-                            new2 = str()
-                            for k in new1:
-                                if k is not ')':
-                                    new2 += k
-                            new3 = str()
-                            new3 = new[0:i] + new2 + new[j:len(new)]
-                            l = i
-                            while l >= 0:
-                                if new3[l] == '(':
-                                    new4 = str()
-                                    new4 = new3[:l] + new3[l + 1:]
-                                    new = new4
-                                    i = 0
-                                    j = 0
-                                    l = -1
-                                else:
-                                    l -= 1
-                            j = len(new)    
-                        else:
-                            j = len(new)
-                    else:
-                        j += 1
-            elif new[i] in oplist3:
-                j = i + 1
-                while j < len(new):
-                    if new[j] in oplist:
-                        if new[j] in oplist3 or new[j] in oplist2:
-                            new1 = new[i:j]
-                            new2 = str()
-                            for k in new1:
-                                if k is not ')':
-                                    new2 += k
-                            new3 = str()
-                            new3 = new[0:i] + new2 + new[j:len(new)]
-                            l = i
-                            while l >= 0:
-                                if new3[l] == '(':
-                                    new4 = str()
-                                    new4 = new3[:l] + new3[l + 1:]
-                                    new = new4
-                                    i = 0
-                                    j = 0
-                                    l = -1
-                                else:
-                                    l -= 1
-                            j = len(new)    
-                        else:
-                            j = len(new)
-                    else:
-                        j += 1 
-            if new[i] in oplist4:
-                j = i + 1
-                while j < len(new):
-                    if new[j] in oplist:
-                        if new[j] in oplist4:
-                            new1 = new[i:j]
-                            new2 = str()
-                            for k in new1:
-                                if k is not ')':
-                                    new2 += k
-                            new3 = str()
-                            new3 = new[0:i] + new2 + new[j:len(new)]
-                            l = i
-                            while l >= 0:
-                                if new3[l] == '(':
-                                    new4 = str()
-                                    new4 = new3[:l] + new3[l + 1:]
-                                    new = new4
-                                    i = 0
-                                    j = 0
-                                    l = -1
-                                else:
-                                    l -= 1
-                            j = len(new)    
-                        else:
-                            j = len(new)
-                    else:
-                        j += 1            
-            i = len(new)
-        else:
-           i += 1
-    return new
+    return tostring(self, minimal = True)
+
 
-    
 class Constant(Expression):
     """Represents a constant value"""
     def __init__(self, value):
@@ -510,12 +310,6 @@ class BinaryNode(Expression):
         else:
             return False
             
-    def __str__(self):
-        lstring = str(self.lhs)
-        rstring = str(self.rhs)
-        
-        # TODO: do we always need parantheses?
-        return "(%s %s %s)" % (lstring, self.op_symbol, rstring)
         
 class AddNode(BinaryNode):
     """Represents the addition operator"""
@@ -15,7 +15,7 @@ expt = Expression.fromString('1+2**3+3+4**2')
 print(expr)
 
 print(expt)
-expr.expteq(expt)
+print(expr.compare(expt))
 print(c.evaluate())
 print(e.evaluate())
 print(f.evaluate())